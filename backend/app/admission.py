@@ -0,0 +1,107 @@
+# admission.py (Kiểm soát tải cho các endpoint tìm kiếm: giới hạn hàng đợi, gộp truy vấn trùng, hủy request cũ)
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+class Overloaded(Exception):
+    """ Quá tải -> API trả 429 kèm Retry-After """
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Superseded(Exception):
+    """ Request bị hủy vì cùng client đã gửi request mới hơn cho cùng endpoint """
+
+class AdmissionController:
+    """
+    Thread pool riêng có giới hạn cho 1 loại việc nặng (embedding, truy vấn ES).
+    - Tối đa `max_concurrency` việc chạy cùng lúc, `max_queue` việc chờ; vượt quá -> Overloaded.
+    - Việc ưu tiên thấp (priority='low') bị từ chối sớm hơn, khi hàng đợi đã đầy `shed_ratio`.
+    """
+    def __init__(self, name, max_concurrency, max_queue, shed_ratio=0.5):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.low_priority_limit = max_concurrency + int(max_queue * shed_ratio)
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-worker")
+        self._lock = threading.Lock()
+        self.in_flight = 0 # Đang chạy + đang chờ trong pool
+        self.stats = {"accepted": 0, "shed_low": 0, "rejected": 0}
+
+    def _release(self, _future):
+        with self._lock: self.in_flight -= 1
+
+    async def run(self, fn, *args, priority='normal'):
+        with self._lock:
+            if self.in_flight >= self.max_concurrency + self.max_queue:
+                self.stats["rejected"] += 1
+                raise Overloaded(f"Hệ thống quá tải ({self.name}), thử lại sau.")
+            if priority == 'low' and self.in_flight >= self.low_priority_limit:
+                self.stats["shed_low"] += 1
+                raise Overloaded(f"Hệ thống đang bận ({self.name}), bỏ qua request ưu tiên thấp.")
+            self.in_flight += 1
+            self.stats["accepted"] += 1
+        future = self.executor.submit(fn, *args)
+        # Giảm bộ đếm khi việc thật sự xong (hoặc bị hủy lúc còn chờ), không phải khi người gọi bỏ đi
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future) # Hủy ở đây -> hủy luôn việc còn trong hàng đợi
+
+    def status(self):
+        return {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue, **self.stats}
+
+class SingleFlight:
+    """ Các truy vấn giống hệt nhau đang chạy dùng chung 1 lần thực thi """
+    def __init__(self):
+        self._calls = {} # key -> [task, số người chờ]
+        self.coalesced = 0
+
+    async def do(self, key, coro_fn):
+        entry = self._calls.get(key)
+        if entry is None or entry[0].done():
+            entry = self._calls[key] = [asyncio.ensure_future(coro_fn()), 0]
+            entry[0].add_done_callback(lambda _task, key=key, entry=entry: self._calls.pop(key) if self._calls.get(key) is entry else None)
+        else:
+            self.coalesced += 1
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0])
+        finally:
+            entry[1] -= 1
+            # Không còn ai chờ kết quả -> hủy luôn việc chung
+            if entry[1] == 0 and not entry[0].done():
+                if self._calls.get(key) is entry: del self._calls[key] # Request mới không được gắn vào việc đang bị hủy
+                entry[0].cancel()
+
+class LatestOnly:
+    """ Mỗi (client, endpoint) chỉ giữ request mới nhất; request cũ đang chạy bị hủy """
+    def __init__(self):
+        self._tasks = {}
+        self.superseded = 0
+
+    async def run(self, key, coro):
+        previous = self._tasks.get(key)
+        if previous is not None and not previous.done():
+            previous.cancel()
+            self.superseded += 1
+        task = self._tasks[key] = asyncio.ensure_future(coro)
+        try:
+            return await task
+        except asyncio.CancelledError:
+            if self._tasks.get(key) is not task: raise Superseded("Đã có request mới hơn từ cùng client.")
+            raise
+        finally:
+            if self._tasks.get(key) is task: del self._tasks[key]
+
+# --- Instance dùng chung cho cả app ---
+embedding_admission = AdmissionController(
+    "embed", int(os.getenv("EMBED_MAX_CONCURRENCY", 2)), int(os.getenv("EMBED_MAX_QUEUE", 32)),
+    shed_ratio=float(os.getenv("SHED_LOW_PRIORITY_RATIO", 0.5))
+)
+search_admission = AdmissionController(
+    "search", int(os.getenv("SEARCH_MAX_CONCURRENCY", 8)), int(os.getenv("SEARCH_MAX_QUEUE", 64)),
+    shed_ratio=float(os.getenv("SHED_LOW_PRIORITY_RATIO", 0.5))
+)
+single_flight = SingleFlight()
+latest_only = LatestOnly()
@@ -1,26 +1,44 @@
 # es_client.py (Sửa semantic_search_suggestions để nối category)
 import os
+import base64
 from elasticsearch import Elasticsearch, helpers
 from dotenv import load_dotenv
-import asyncio
 import json
 from sentence_transformers import SentenceTransformer
 import random
+import time
+import numpy as np
+from .rerank import candidate_count, diversify_hits
+from .admission import Overloaded, embedding_admission, search_admission
 
 # --- Phần tải model (Giữ nguyên) ---
 try:
     EMBEDDING_MODEL_NAME = os.getenv('MODEL_NAME', 'sentence-transformers/all-MiniLM-L6-v2')
-    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device='cpu')
-    print(f"✅ Tải mô hình embedding '{EMBEDDING_MODEL_NAME}' thành công.")
+    if os.getenv('TORCH_NUM_THREADS'): # Chế độ nhiều worker: gunicorn.conf.py đặt lại cho từng worker
+        import torch
+        torch.set_num_threads(int(os.getenv('TORCH_NUM_THREADS')))
+    # Cùng MODEL_REVISION với pipeline (embed_to_json.py): vector truy vấn và vector trong index từ cùng 1 bản model
+    EMBEDDING_MODEL_REVISION = os.getenv('MODEL_REVISION') or None
+    embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME, device='cpu', revision=EMBEDDING_MODEL_REVISION)
+    print(f"✅ Tải mô hình embedding '{EMBEDDING_MODEL_NAME}' (revision: {EMBEDDING_MODEL_REVISION or 'mặc định'}) thành công.")
 except Exception as e:
     print(f"❌ LỖI NGHIÊM TRỌNG: Không thể tải mô hình embedding: {e}")
     embedding_model = None
 
 load_dotenv()
 
+CATEGORY_CACHE_TTL = float(os.getenv("CATEGORY_CACHE_TTL", 60)) # giây
+KEYWORD_QUERY_MODE = os.getenv("KEYWORD_QUERY_MODE", "multi_match") # multi_match | legacy
+PROJECTION_CHECK_TTL = float(os.getenv("PROJECTION_CHECK_TTL", 60)) # giây giữa 2 lần kiểm tra _meta của index
+
 class ESClient:
     def __init__(self):
-        # (Giữ nguyên)
+        self._categories = None # (thời điểm tải, list category) - nạp trước ở master khi chạy nhiều worker
+        self._projections = {} # index -> (thời điểm kiểm tra, phép chiếu hoặc None)
+        self.reconnect()
+
+    def reconnect(self):
+        """ Tạo kết nối mới (gọi lại trong mỗi worker sau khi fork) """
         host = os.getenv("ELASTICSEARCH_HOST", "http://localhost:9200")
         try:
             self.client = Elasticsearch(
@@ -30,20 +48,86 @@ class ESClient:
             print(f"✅ Kết nối ES thành công tại {host}")
         except Exception as e: print(f"❌ Lỗi kết nối ES: {e}"); raise
 
-    # --- HÀM KEYWORD SEARCH (Giữ nguyên) ---
-    def keyword_search(self, index_name, query_text, category_filter=None, size=20):
-        # (Giữ nguyên code hàm này)
+    def get_categories(self, index_name, max_age=CATEGORY_CACHE_TTL):
+        """ Danh sách category (cache trong process, làm mới sau max_age giây) """
+        if self._categories and time.time() - self._categories[0] < max_age: return self._categories[1]
+        try:
+            query = {"size": 0, "aggs": {"unique_categories": {"terms": {"field": "category", "size": 100}}}}
+            res = self.client.search(index=index_name, body=query, request_timeout=30)
+            categories = sorted(bucket["key"] for bucket in res["aggregations"]["unique_categories"]["buckets"])
+            self._categories = (time.time(), categories)
+            return categories
+        except Exception as e:
+            print(f"Lỗi lấy categories: {e}")
+            return self._categories[1] if self._categories else []
+
+    # --- PHÉP CHIẾU GIẢM CHIỀU (index tạo với VECTOR_PROJECTION=pca|truncate) ---
+    def get_projection(self, index_name, max_age=PROJECTION_CHECK_TTL):
+        """
+        Phép chiếu của index: version ghi ở mapping _meta.projection, ma trận lưu ở index '<index>_projection'.
+        Cache trong process; sau max_age giây kiểm tra lại _meta, version đổi (import lại) -> nạp lại.
+        Trả về None nếu index dùng vector đầy đủ chiều.
+        """
+        cached = self._projections.get(index_name)
+        if cached and time.time() - cached[0] < max_age: return cached[1]
+        try:
+            mapping = self.client.indices.get_mapping(index=index_name)
+            meta = next(iter(mapping.values()))['mappings'].get('_meta', {}).get('projection')
+            projection = cached[1] if cached else None
+            if not meta: projection = None
+            elif projection is None or projection['version'] != meta['version']:
+                doc = self.client.get(index=f"{index_name}_projection", id=meta['version'])['_source']
+                source_dim, dim = doc['source_dim'], doc['dim']
+                projection = {
+                    "version": meta['version'], "dim": dim,
+                    "mean": np.frombuffer(base64.b64decode(doc['mean']), dtype=np.float32).reshape(source_dim),
+                    "components": np.frombuffer(base64.b64decode(doc['components']), dtype=np.float32).reshape(dim, source_dim),
+                }
+                print(f"📐 Nạp phép chiếu {doc['method']} {source_dim} -> {dim} chiều (version {meta['version']}) cho index '{index_name}'")
+            self._projections[index_name] = (time.time(), projection)
+            return projection
+        except Exception as e:
+            print(f"Lỗi nạp phép chiếu vector: {e}")
+            return cached[1] if cached else None
+
+    def project_vectors(self, index_name, vectors):
+        """ Chiếu vector (1 hoặc N x source_dim) về số chiều của index, chuẩn hóa L2. Index không có phép chiếu -> giữ nguyên. """
+        projection = self.get_projection(index_name)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if projection is None: return vectors
+        projected = (vectors - projection['mean']) @ projection['components'].T
+        return projected / np.maximum(np.linalg.norm(projected, axis=-1, keepdims=True), 1e-12)
+
+    # --- HÀM KEYWORD SEARCH ---
+    @staticmethod
+    def build_keyword_query(query_text, query_mode=KEYWORD_QUERY_MODE):
+        """
+        'multi_match' (mặc định): 1 mệnh đề multi_match trên cả field gốc và subfield .folded (bỏ dấu),
+            số mệnh đề không tăng theo số từ. Index cũ không có .folded thì subfield bị bỏ qua.
+        'legacy': 2 mệnh đề match cho mỗi từ (cách cũ, giữ để so sánh benchmark).
+        """
+        if query_mode == "legacy":
+            should_clauses = []
+            for keyword in query_text.split():
+                should_clauses.append({"match": {"name": {"query": keyword, "boost": 2}}})
+                should_clauses.append({"match": {"description": keyword}})
+            return {"bool": {"should": should_clauses, "minimum_should_match": 1, "filter": []}}
+        return {"bool": {
+            "must": [{"multi_match": {
+                "query": query_text, "type": "most_fields", "operator": "or",
+                "fields": ["name^2", "name.folded^1.5", "description", "description.folded^0.5"]
+            }}],
+            "filter": []
+        }}
+
+    def keyword_search(self, index_name, query_text, category_filter=None, size=20, query_mode=KEYWORD_QUERY_MODE):
         if not query_text: return []
         keywords = query_text.split()
         if not keywords: return []
-        should_clauses = []
-        for keyword in keywords:
-            should_clauses.append({"match": {"name": {"query": keyword, "boost": 2}}})
-            should_clauses.append({"match": {"description": keyword}})
-        query_body = {"size": size, "query": {"bool": {"should": should_clauses, "minimum_should_match": 1, "filter": []}}}
+        query_body = {"size": size, "query": self.build_keyword_query(query_text, query_mode)}
         if category_filter: query_body["query"]["bool"]["filter"].append({"term": {"category": category_filter}})
         try:
-            print(f"🔍 Tìm kiếm Keyword (Keywords: {keywords}, Category: {category_filter})...")
+            print(f"🔍 Tìm kiếm Keyword (Keywords: {keywords}, Category: {category_filter}, Mode: {query_mode})...")
             res = self.client.search(index=index_name, body=query_body)
             hits = [{"_id": hit['_id'], **hit['_source']} for hit in res['hits']['hits']]
             print(f"✅ Tìm thấy {len(hits)} kết quả Keyword.")
@@ -53,7 +137,7 @@ class ESClient:
 
 
     # --- HÀM SEMANTIC SUGGESTIONS (SỬA ĐỂ NỐI CATEGORY VÀO TEXT) ---
-    async def semantic_search_suggestions(self, index_name, query_text, category_filter=None, k=5):
+    async def semantic_search_suggestions(self, index_name, query_text, category_filter=None, k=5, mmr_lambda=None, priority='normal'):
         if embedding_model is None: raise RuntimeError("Mô hình embedding chưa tải.")
 
         # === THAY ĐỔI Ở ĐÂY ===
@@ -64,12 +148,16 @@ class ESClient:
         # =====================
 
         print(f"🧠 Đang tạo embedding (suggestions) cho: '{text_to_embed}'") # Log text mới
-        loop = asyncio.get_event_loop()
         try:
-            # Dùng text_to_embed để tạo vector
-            query_vector_np = await loop.run_in_executor(None, embedding_model.encode, text_to_embed)
-            query_vector = query_vector_np.tolist()
+            # Dùng text_to_embed để tạo vector (thread pool riêng, có giới hạn hàng đợi)
+            query_vector_np = await embedding_admission.run(embedding_model.encode, text_to_embed, priority=priority)
+        except Overloaded: raise
         except Exception as e: raise RuntimeError(f"❌ Lỗi tạo embedding: {e}")
+        # Chiếu vector + gọi ES là I/O đồng bộ -> chạy trên thread pool tìm kiếm, không chặn event loop
+        return await search_admission.run(self._semantic_knn, index_name, query_vector_np, k, mmr_lambda, priority=priority)
+
+    def _semantic_knn(self, index_name, query_vector_np, k, mmr_lambda):
+        query_vector = self.project_vectors(index_name, query_vector_np).tolist() # Cùng phép chiếu với lúc import
 
         # --- BỎ FILTER CATEGORY Ở ĐÂY ---
         # Elasticsearch sẽ tìm dựa trên vector đã bao gồm category
@@ -78,6 +166,10 @@ class ESClient:
         # query_body = {"bool": {"filter": es_filters}} if es_filters else None
         # --- KẾT THÚC BỎ FILTER ---
 
+        if mmr_lambda is not None: # Lấy dư ứng viên kèm vector rồi xếp lại bằng MMR
+            hits = self.knn_candidates(index_name, query_vector, candidate_count(k))
+            return diversify_hits(hits, query_vector, k, mmr_lambda)
+
         knn_query = {"field": "product_embedding", "query_vector": query_vector, "k": k, "num_candidates": 50}
 
         try:
@@ -135,6 +227,97 @@ class ESClient:
             return hits
         except Exception as e: print(f"❌ Lỗi kNN: {e}"); return []
 
+    def knn_candidates(self, index_name, query_vector, num_hits, exclude_id=None):
+        """ Lấy dư ứng viên kNN (kèm vector) cho bước re-rank. exclude_id lọc trước trong kNN. """
+        try:
+            knn_query = {"field": "product_embedding", "query_vector": query_vector, "k": num_hits, "num_candidates": max(50, num_hits * 2)}
+            if exclude_id: knn_query["filter"] = {"bool": {"must_not": [{"ids": {"values": [exclude_id]}}]}}
+            res = self.client.search(index=index_name, knn=knn_query, size=num_hits, _source=True)
+            return [{"_id": hit['_id'], "product": hit['_source'], "score": hit['_score']} for hit in res['hits']['hits']]
+        except Exception as e: print(f"❌ Lỗi kNN (ứng viên re-rank): {e}"); return []
+
+    def knn_search_diverse(self, index_name, query_vector, k=5, exclude_id=None, mmr_lambda=0.7):
+        """ kNN + MMR: tránh để các biến thể gần trùng của cùng 1 sản phẩm chiếm hết chỗ gợi ý """
+        hits = self.knn_candidates(index_name, query_vector, candidate_count(k), exclude_id=exclude_id)
+        return diversify_hits(hits, query_vector, k, mmr_lambda)
+
+    # --- CÁC HÀM BATCH (mget + msearch): N sản phẩm -> 2 round trip thay vì 2N ---
+    def mget_documents(self, index_name, doc_ids, source_excludes=None, raise_on_error=False):
+        """
+        Lấy nhiều document bằng 1 lệnh _mget. Trả về dict {_id: doc} (chỉ các doc tồn tại).
+        raise_on_error=True: lỗi ES (cả lỗi riêng từng doc) được ném ra thay vì trả về {} / bỏ qua doc.
+        """
+        if not doc_ids: return {}
+        try:
+            kwargs = {"_source_excludes": source_excludes} if source_excludes else {}
+            res = self.client.mget(index=index_name, ids=list(doc_ids), **kwargs)
+            errors = [d for d in res['docs'] if 'error' in d]
+            if errors and raise_on_error: raise RuntimeError(f"Lỗi mget doc {errors[0]['_id']}: {errors[0]['error']}")
+            return {d['_id']: {"_id": d['_id'], **d.get('_source', {})} for d in res['docs'] if d.get('found')}
+        except Exception as e:
+            if raise_on_error: raise
+            print(f"❌ Lỗi mget: {e}"); return {}
+
+    def knn_search_batch(self, index_name, query_vectors, k=5, exclude_ids=None):
+        """ Chạy nhiều truy vấn kNN bằng 1 lệnh _msearch. Trả về list kết quả, cùng thứ tự với query_vectors """
+        if not query_vectors: return []
+        exclude_ids = list(exclude_ids or [])
+        searches = []
+        for query_vector in query_vectors:
+            knn_query = {"field": "product_embedding", "query_vector": query_vector, "k": k, "num_candidates": max(50, k)}
+            # Lọc trước (pre-filter) trong kNN để không mất slot cho các sản phẩm đầu vào
+            if exclude_ids: knn_query["filter"] = {"bool": {"must_not": [{"ids": {"values": exclude_ids}}]}}
+            searches.append({})
+            searches.append({"knn": knn_query, "size": k, "_source": {"excludes": ["product_embedding"]}})
+        try:
+            res = self.client.msearch(index=index_name, searches=searches)
+            results = []
+            for response in res['responses']:
+                if 'error' in response:
+                    print(f"❌ Lỗi kNN (msearch): {response['error']}")
+                    results.append([])
+                    continue
+                results.append([{"_id": hit['_id'], "product": hit['_source'], "score": hit['_score']} for hit in response['hits']['hits']])
+            return results
+        except Exception as e: print(f"❌ Lỗi kNN batch: {e}"); return [[] for _ in query_vectors]
+
+    def recommend_batch(self, index_name, doc_ids, k=5, blend=False):
+        """
+        Gợi ý cho nhiều sản phẩm cùng lúc (giỏ hàng, "đã xem gần đây"...).
+        - blend=False: mỗi sản phẩm 1 truy vấn kNN (chung 1 _msearch), gộp + loại trùng, giữ điểm cao nhất.
+        - blend=True: 1 truy vấn kNN duy nhất từ vector trung bình (centroid) của các sản phẩm.
+        """
+        doc_ids = list(dict.fromkeys(doc_ids)) # Loại ID trùng, giữ thứ tự
+        originals = self.mget_documents(index_name, doc_ids)
+        missing_ids = [doc_id for doc_id in doc_ids if doc_id not in originals]
+        found_ids = [doc_id for doc_id in doc_ids if doc_id in originals and originals[doc_id].get('product_embedding')]
+        vectors = [originals[doc_id]['product_embedding'] for doc_id in found_ids]
+
+        if not vectors:
+            recommendations = []
+        elif blend:
+            centroid = np.asarray(vectors, dtype=np.float32).mean(axis=0)
+            norm = np.linalg.norm(centroid)
+            if norm > 0: centroid /= norm
+            hits = self.knn_search_batch(index_name, [centroid.tolist()], k=k, exclude_ids=doc_ids)[0]
+            recommendations = [{**hit, "source_ids": found_ids} for hit in hits]
+        else:
+            merged = {}
+            for source_id, hits in zip(found_ids, self.knn_search_batch(index_name, vectors, k=k, exclude_ids=doc_ids)):
+                for hit in hits:
+                    entry = merged.get(hit['_id'])
+                    if entry is None: merged[hit['_id']] = entry = {**hit, "source_ids": []}
+                    elif hit['score'] > entry['score']: entry['score'] = hit['score']
+                    entry['source_ids'].append(source_id)
+            recommendations = sorted(merged.values(), key=lambda r: r['score'], reverse=True)
+
+        original_products = {
+            doc_id: {key: value for key, value in originals[doc_id].items() if key not in ('_id', 'product_embedding')}
+            for doc_id in doc_ids if doc_id in originals
+        }
+        print(f"✅ Gợi ý batch: {len(doc_ids)} sản phẩm -> {len(recommendations)} gợi ý (blend={blend}).")
+        return {"original_products": original_products, "recommendations": recommendations, "missing_ids": missing_ids}
+
 
 # --- Tạo instance (Giữ nguyên) ---
 try:
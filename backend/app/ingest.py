@@ -0,0 +1,159 @@
+# ingest.py (Ghi thay đổi catalog theo thời gian thực: gom lô + bulk)
+import asyncio
+import time
+from elasticsearch import helpers
+
+# Các trường đi vào đoạn text được embed. Đổi trường khác (giá, ảnh...) không cần embed lại.
+EMBEDDED_FIELDS = ('name', 'description', 'category')
+
+def build_embedding_text(product):
+    """ PHẢI giống hệt build_embedding_text trong scripts/embed_to_json.py """
+    return f"Tên: {product.get('name','')}. Mô tả: {product.get('description','')}. Danh mục: {product.get('category','')}"
+
+class IngestQueueFull(Exception):
+    """ Hàng đợi ghi đã đầy (backpressure) -> API trả 429 """
+
+_FLUSH = object() # Marker: kết thúc lô hiện tại ngay
+
+class ProductWriteBuffer:
+    """
+    Hàng đợi ghi nền cho các thay đổi sản phẩm.
+    - Gom thao tác thành lô, xả khi đủ `max_batch` hoặc sau `flush_interval` giây.
+    - Mỗi lô: 1 _mget (lấy bản hiện tại cho các cập nhật), 1 lần encode cho mọi text cần embed, 1 _bulk.
+    - Cập nhật không đổi name/description/category thì không embed lại.
+    - Hàng đợi có giới hạn `max_pending`: đầy thì submit() ném IngestQueueFull.
+    """
+    def __init__(self, es_client, index_name, embed_fn, max_batch=500, flush_interval=1.0, max_pending=10000):
+        self.es_client = es_client
+        self.index_name = index_name
+        self.embed_fn = embed_fn # list[str] -> ma trận (N x dim), chạy trong thread pool
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.queue = None
+        self._task = None
+        self.stats = {"indexed": 0, "updated": 0, "deleted": 0, "embedded": 0, "embed_skipped": 0,
+                      "failed": 0, "batches": 0, "last_flush_at": None, "last_batch_seconds": None, "last_error": None}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None: return
+        await self.flush()
+        self._task.cancel()
+        try: await self._task
+        except asyncio.CancelledError: pass
+        self._task = None
+
+    def submit(self, op, doc_id, doc=None):
+        """ op: 'index' (sản phẩm đầy đủ), 'update' (một phần trường), 'delete' """
+        if self.queue is None: raise RuntimeError("Hàng đợi ghi chưa khởi động.")
+        try: self.queue.put_nowait((op, doc_id, doc))
+        except asyncio.QueueFull: raise IngestQueueFull(f"Hàng đợi ghi đầy ({self.max_pending} thao tác).")
+        return self.queue.qsize()
+
+    async def flush(self):
+        """ Xả ngay mọi thao tác đã nhận và chờ ghi xong """
+        if self.queue is None: return self.status()
+        await self.queue.put(_FLUSH)
+        await self.queue.join()
+        return self.status()
+
+    def status(self):
+        return {"pending": self.queue.qsize() if self.queue else 0, "max_pending": self.max_pending,
+                "max_batch": self.max_batch, "flush_interval": self.flush_interval, **self.stats}
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self.queue.get()
+            batch = [] if item is _FLUSH else [item]
+            markers = 1 if item is _FLUSH else 0
+            deadline = loop.time() + self.flush_interval
+            while item is not _FLUSH and len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0: break
+                try: item = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError: break
+                if item is _FLUSH: markers += 1
+                else: batch.append(item)
+            try:
+                if batch: await self._write_batch(batch)
+            except Exception as e:
+                self.stats["failed"] += len(batch)
+                self.stats["last_error"] = str(e)
+                print(f"❌ Lỗi ghi lô admin ({len(batch)} thao tác): {e}")
+            finally:
+                for _ in range(len(batch) + markers): self.queue.task_done()
+
+    @staticmethod
+    def _coalesce(batch):
+        """
+        Gộp nhiều thao tác trên cùng 1 ID trong lô thành 1 thao tác cuối cùng.
+        'update' sau 'delete' không có document để cập nhật (ES cũng sẽ báo lỗi) -> giữ 'delete', trả về
+        ID của các update bị bỏ để tính là lỗi.
+        """
+        merged, dropped_updates = {}, []
+        for op, doc_id, doc in batch:
+            previous = merged.pop(doc_id, None) # pop để giữ thứ tự theo lần ghi cuối
+            if op == 'update' and previous and previous[0] in ('index', 'update'):
+                merged[doc_id] = (previous[0], {**previous[1], **doc})
+            elif op == 'update' and previous and previous[0] == 'delete':
+                merged[doc_id] = previous
+                dropped_updates.append(doc_id)
+            else:
+                merged[doc_id] = (op, doc)
+        return merged, dropped_updates
+
+    async def _write_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        ops, dropped_updates = self._coalesce(batch)
+
+        # Cập nhật có chạm vào trường được embed -> so với bản hiện tại trong ES (1 lệnh _mget cho cả lô).
+        # Lỗi _mget làm hỏng cả lô (tính vào failed) thay vì ghi text mới với vector cũ.
+        update_ids = [doc_id for doc_id, (op, doc) in ops.items() if op == 'update' and any(f in doc for f in EMBEDDED_FIELDS)]
+        current_docs = await loop.run_in_executor(
+            None, lambda: self.es_client.mget_documents(self.index_name, update_ids, source_excludes=["product_embedding"], raise_on_error=True)
+        ) if update_ids else {}
+
+        to_embed = [] # (doc_id, text)
+        for doc_id, (op, doc) in ops.items():
+            if op == 'index':
+                to_embed.append((doc_id, build_embedding_text(doc)))
+            elif op == 'update' and doc_id in current_docs:
+                current = current_docs[doc_id]
+                new_text = build_embedding_text({**current, **doc})
+                if new_text != build_embedding_text(current): to_embed.append((doc_id, new_text))
+                else: self.stats["embed_skipped"] += 1
+            elif op == 'update':
+                self.stats["embed_skipped"] += 1
+
+        if to_embed:
+            vectors = await loop.run_in_executor(None, self.embed_fn, [text for _, text in to_embed])
+            for (doc_id, _), vector in zip(to_embed, vectors):
+                ops[doc_id][1]["product_embedding"] = vector.tolist()
+            self.stats["embedded"] += len(to_embed)
+
+        actions = []
+        for doc_id, (op, doc) in ops.items():
+            if op == 'index': actions.append({"_op_type": "index", "_index": self.index_name, "_id": doc_id, "_source": {**doc, "id": doc_id}})
+            elif op == 'update': actions.append({"_op_type": "update", "_index": self.index_name, "_id": doc_id, "doc": doc})
+            else: actions.append({"_op_type": "delete", "_index": self.index_name, "_id": doc_id})
+
+        success_count, failed_items = await loop.run_in_executor(
+            None, lambda: helpers.bulk(self.es_client.client, actions, raise_on_error=False, raise_on_exception=False, request_timeout=60)
+        )
+        failed_ids = {next(iter(item.values())).get('_id') for item in failed_items}
+        for doc_id, (op, _) in ops.items():
+            if doc_id in failed_ids: continue
+            self.stats[{"index": "indexed", "update": "updated", "delete": "deleted"}[op]] += 1
+        self.stats["failed"] += len(failed_items) + len(dropped_updates)
+        if dropped_updates: self.stats["last_error"] = f"Cập nhật sau khi xóa trong cùng lô (bị bỏ): {', '.join(dropped_updates[:5])}"
+        if failed_items: self.stats["last_error"] = str(next(iter(failed_items[0].values())).get('error'))
+        self.stats["batches"] += 1
+        self.stats["last_flush_at"] = time.time()
+        self.stats["last_batch_seconds"] = round(time.time() - start, 4)
+        print(f"✅ Ghi lô admin: {len(batch)} thao tác -> {success_count} thành công, {len(failed_items) + len(dropped_updates)} lỗi, {len(to_embed)} embed.")
@@ -1,8 +1,11 @@
 # main.py (Sửa lại endpoint /products để unpack)
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Header, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from .es_client import es_client, embedding_model # Import đúng
+from .es_client import es_client, embedding_model, KEYWORD_QUERY_MODE # Import đúng
+from .ingest import ProductWriteBuffer, IngestQueueFull
+from .admission import Overloaded, Superseded, embedding_admission, search_admission, single_flight, latest_only
 from typing import List, Optional
+from pydantic import BaseModel, Field
 import os
 
 app = FastAPI(
@@ -15,47 +18,141 @@ app.add_middleware(
 )
 
 INDEX_NAME = os.getenv("INDEX_NAME", "products")
+MAX_BATCH_IDS = int(os.getenv("MAX_BATCH_IDS", 100))
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN") # Nếu đặt, các endpoint /admin yêu cầu header X-Admin-Token
+# Số worker (gunicorn.conf.py ghi lại WEB_CONCURRENCY). Hàng đợi ghi admin, single-flight và việc hủy request cũ
+# là state riêng của từng worker -> /admin/products* chỉ bật khi chạy 1 worker.
+WORKER_COUNT = int(os.getenv("WEB_CONCURRENCY", 1))
+
+# Nạp trước state chỉ đọc khi import: với gunicorn --preload, master nạp 1 lần và các worker dùng chung
+if es_client is not None:
+    es_client.get_categories(INDEX_NAME)
+    es_client.get_projection(INDEX_NAME) # Phép chiếu giảm chiều của index (nếu có)
+
+# --- Hàng đợi ghi cho /admin/products (gom lô theo số lượng hoặc thời gian) ---
+write_buffer = ProductWriteBuffer(
+    es_client, INDEX_NAME,
+    embed_fn=lambda texts: es_client.project_vectors(INDEX_NAME, embedding_model.encode(texts, convert_to_numpy=True)),
+    max_batch=int(os.getenv("INGEST_MAX_BATCH", 500)),
+    flush_interval=float(os.getenv("INGEST_FLUSH_INTERVAL", 1.0)),
+    max_pending=int(os.getenv("INGEST_MAX_PENDING", 10000)),
+)
+
+# --- Body cho các endpoint batch ---
+class ProductIdsRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+
+class BatchRecommendRequest(BaseModel):
+    ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_IDS)
+    k: int = Field(5, ge=1, le=50)
+    blend: bool = False # True: gợi ý từ vector trung bình của các sản phẩm
+
+# --- Body cho các endpoint /admin/products ---
+class ProductCreate(BaseModel):
+    id: str = Field(..., min_length=1)
+    name: str = Field(..., min_length=1)
+    description: str = ""
+    category: str = "Chưa phân loại"
+    price: Optional[float] = None
+    image_url: str = ""
+
+class ProductUpdate(BaseModel):
+    name: Optional[str] = Field(None, min_length=1)
+    description: Optional[str] = None
+    category: Optional[str] = None
+    price: Optional[float] = None
+    image_url: Optional[str] = None
 
 @app.on_event("startup")
 async def startup_event():
     if es_client is None: raise RuntimeError("Không thể kết nối tới Elasticsearch.")
     if embedding_model is None: print("⚠️ CẢNH BÁO: Mô hình embedding chưa tải xong...")
+    if WORKER_COUNT == 1: await write_buffer.start()
     print("✅ FastAPI đã khởi động và kết nối ES thành công.")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    await write_buffer.stop() # Ghi nốt các thay đổi còn trong hàng đợi
+
 @app.get("/")
 def read_root(): return {"message": "Welcome to the Recommendation API!"}
 
+# --- Kiểm soát tải cho các endpoint tìm kiếm ---
+def client_key(request: Request, endpoint):
+    """
+    Định danh client theo header X-Client-Id (mỗi tab frontend 1 ID). Không có header -> None:
+    không dùng IP vì nhiều người dùng sau cùng NAT/proxy (hoặc caller phía server) sẽ hủy request của nhau.
+    """
+    client_id = request.headers.get("x-client-id")
+    return (client_id, endpoint) if client_id else None
+
+def request_priority(request: Request):
+    return "low" if request.headers.get("x-priority", "").lower() == "low" else "normal"
+
+async def admitted(request: Request, endpoint, flight_key, coro_fn):
+    """
+    - Gộp các truy vấn giống hệt đang chạy (single-flight)
+    - Hủy request cũ của cùng client cho cùng endpoint (409), chỉ khi có X-Client-Id
+    - Quá tải -> 429 + Retry-After
+    """
+    key = client_key(request, endpoint)
+    try:
+        if key is None: return await single_flight.do(flight_key, coro_fn)
+        return await latest_only.run(key, single_flight.do(flight_key, coro_fn))
+    except Overloaded as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+    except Superseded as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+@app.get("/admission/status")
+async def admission_status():
+    return {
+        "embedding": embedding_admission.status(), "search": search_admission.status(),
+        "coalesced": single_flight.coalesced, "superseded": latest_only.superseded
+    }
+
 # --- ENDPOINT KEYWORD SEARCH (Giữ nguyên) ---
 @app.get("/search-keyword")
 async def keyword_search_endpoint(
+    request: Request,
     query: str = Query(..., min_length=1),
     category: Optional[str] = Query(None),
-    size: int = Query(20, ge=1, le=100)
+    size: int = Query(20, ge=1, le=100),
+    query_mode: Optional[str] = Query(None, pattern="^(multi_match|legacy)$") # Mặc định theo KEYWORD_QUERY_MODE
 ):
     if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
+    query_mode = query_mode or KEYWORD_QUERY_MODE
     try:
-        results = es_client.keyword_search(
-            index_name=INDEX_NAME, query_text=query,
-            category_filter=category, size=size
+        # Chạy trong thread pool có giới hạn thay vì chặn event loop
+        results = await admitted(
+            request, "keyword", ("keyword", query, category, size, query_mode),
+            lambda: search_admission.run(es_client.keyword_search, INDEX_NAME, query, category, size, query_mode, priority=request_priority(request))
         )
         return results # Trả về list [...]
+    except HTTPException as he: raise he
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Lỗi keyword search: {e}")
 
 # --- ENDPOINT SEMANTIC SUGGESTIONS (Giữ nguyên) ---
 @app.get("/search-semantic-suggestions")
 async def semantic_suggestions_endpoint(
+    request: Request,
     query: str = Query(..., min_length=1),
-    category: Optional[str] = Query(None)
+    category: Optional[str] = Query(None),
+    mmr_lambda: Optional[float] = Query(None, ge=0.0, le=1.0) # Có giá trị -> re-rank đa dạng (MMR)
 ):
     if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
     if embedding_model is None: raise HTTPException(status_code=503, detail="Mô hình embedding lỗi.")
     try:
-        results = await es_client.semantic_search_suggestions(
-            index_name=INDEX_NAME, query_text=query,
-            category_filter=category, k=5
+        results = await admitted(
+            request, "semantic", ("semantic", query, category, mmr_lambda),
+            lambda: es_client.semantic_search_suggestions(
+                index_name=INDEX_NAME, query_text=query,
+                category_filter=category, k=5, mmr_lambda=mmr_lambda, priority=request_priority(request)
+            )
         )
         return results # Trả về list [{_id, product, score}, ...]
+    except HTTPException as he: raise he
     except RuntimeError as e: raise HTTPException(status_code=500, detail=str(e))
     except Exception as e: raise HTTPException(status_code=500, detail=f"Lỗi semantic suggestions: {e}")
 
@@ -85,7 +182,10 @@ async def get_products(
 
 # --- Endpoint /recommend và /categories (Giữ nguyên) ---
 @app.get("/recommend/{product_doc_id}")
-async def get_recommendations(product_doc_id: str):
+async def get_recommendations(
+    product_doc_id: str,
+    mmr_lambda: Optional[float] = Query(None, ge=0.0, le=1.0) # Có giá trị -> re-rank đa dạng (MMR)
+):
     if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
     try:
         original_doc = es_client.get_document(INDEX_NAME, product_doc_id)
@@ -93,20 +193,79 @@ async def get_recommendations(product_doc_id: str):
         product_source = {k: v for k, v in original_doc.items() if k != '_id'}
         query_vector = product_source.get("product_embedding")
         if not query_vector: raise HTTPException(status_code=500, detail="Thiếu embedding vector")
-        recommendations = es_client.knn_search(
-            index_name=INDEX_NAME, query_vector=query_vector, k=5, exclude_id=product_doc_id
-        )
+        if mmr_lambda is not None:
+            recommendations = es_client.knn_search_diverse(
+                index_name=INDEX_NAME, query_vector=query_vector, k=5, exclude_id=product_doc_id, mmr_lambda=mmr_lambda
+            )
+        else:
+            recommendations = es_client.knn_search(
+                index_name=INDEX_NAME, query_vector=query_vector, k=5, exclude_id=product_doc_id
+            )
         return {"original_product": product_source, "recommendations": recommendations}
     except HTTPException as he: raise he
     except Exception as e: raise HTTPException(status_code=500, detail=f"Lỗi gợi ý: {e}")
 
+# --- ENDPOINT BATCH: 1 _mget + 1 _msearch cho N sản phẩm ---
+@app.post("/recommend/batch")
+async def get_batch_recommendations(body: BatchRecommendRequest):
+    if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
+    try:
+        return es_client.recommend_batch(INDEX_NAME, body.ids, k=body.k, blend=body.blend)
+        # Kết quả: {"original_products": {id: {...}}, "recommendations": [{_id, product, score, source_ids}], "missing_ids": [...]}
+    except Exception as e: raise HTTPException(status_code=500, detail=f"Lỗi gợi ý batch: {e}")
+
+@app.post("/products/mget")
+async def mget_products(body: ProductIdsRequest):
+    if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
+    try:
+        docs = es_client.mget_documents(INDEX_NAME, body.ids, source_excludes=["product_embedding"])
+        # Giữ đúng thứ tự ID gửi lên, ID không tồn tại trả về trong "missing_ids"
+        return {
+            "data": [docs[doc_id] for doc_id in dict.fromkeys(body.ids) if doc_id in docs],
+            "missing_ids": [doc_id for doc_id in dict.fromkeys(body.ids) if doc_id not in docs]
+        }
+    except Exception as e: raise HTTPException(status_code=500, detail=f"Lỗi mget sản phẩm: {e}")
+
 @app.get("/categories")
 async def get_categories():
     if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
+    return es_client.get_categories(INDEX_NAME)
+
+
+# --- ENDPOINT /admin/products: ghi thay đổi catalog, có hiệu lực sau vài giây ---
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if ADMIN_TOKEN and x_admin_token != ADMIN_TOKEN: raise HTTPException(status_code=401, detail="Sai X-Admin-Token.")
+    if WORKER_COUNT > 1: # Mỗi worker 1 hàng đợi: flush/status chỉ thấy worker nhận request -> không an toàn
+        raise HTTPException(status_code=503, detail=f"Admin API chỉ hỗ trợ 1 worker (đang chạy {WORKER_COUNT}). "
+                                                    "Chạy 1 instance riêng với WEB_CONCURRENCY=1 cho /admin.")
+
+def enqueue_write(op, doc_id, doc=None):
+    if es_client is None: raise HTTPException(status_code=503, detail="ES client lỗi.")
+    if op != 'delete' and embedding_model is None: raise HTTPException(status_code=503, detail="Mô hình embedding lỗi.")
     try:
-        query = {"size": 0, "aggs": {"unique_categories": {"terms": {"field": "category", "size": 100}}}}
-        res = es_client.client.search(index=INDEX_NAME, body=query, request_timeout=30)
-        categories = [bucket["key"] for bucket in res["aggregations"]["unique_categories"]["buckets"]]
-        categories.sort()
-        return categories
-    except Exception as e: print(f"Lỗi lấy categories: {e}"); return []
\ No newline at end of file
+        pending = write_buffer.submit(op, doc_id, doc)
+        return {"status": "queued", "op": op, "id": doc_id, "pending": pending}
+    except IngestQueueFull as e:
+        raise HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+
+@app.post("/admin/products", status_code=202, dependencies=[Depends(require_admin)])
+async def admin_create_product(product: ProductCreate):
+    return enqueue_write('index', product.id, product.model_dump())
+
+@app.put("/admin/products/{product_id}", status_code=202, dependencies=[Depends(require_admin)])
+async def admin_update_product(product_id: str, product: ProductUpdate):
+    fields = product.model_dump(exclude_unset=True)
+    if not fields: raise HTTPException(status_code=400, detail="Không có trường nào để cập nhật.")
+    return enqueue_write('update', product_id, fields) # Chỉ đổi giá/ảnh -> không embed lại
+
+@app.delete("/admin/products/{product_id}", status_code=202, dependencies=[Depends(require_admin)])
+async def admin_delete_product(product_id: str):
+    return enqueue_write('delete', product_id)
+
+@app.post("/admin/products/flush", dependencies=[Depends(require_admin)])
+async def admin_flush_products():
+    return await write_buffer.flush()
+
+@app.get("/admin/products/status", dependencies=[Depends(require_admin)])
+async def admin_ingest_status():
+    return write_buffer.status()
\ No newline at end of file
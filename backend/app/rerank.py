@@ -0,0 +1,46 @@
+# rerank.py (Đa dạng hóa kết quả gợi ý: MMR + gộp sản phẩm gần trùng, tính bằng NumPy)
+import numpy as np
+
+MMR_FETCH_FACTOR = 4 # Lấy dư k * 4 ứng viên từ kNN để có chỗ chọn
+MAX_MMR_CANDIDATES = 100 # Chặn trên số ứng viên: ma trận N x N nhỏ -> độ trễ cố định
+DEFAULT_DEDUP_THRESHOLD = 0.97 # Cosine >= ngưỡng này với 1 sản phẩm đã chọn -> coi là biến thể, bỏ
+
+def candidate_count(k):
+    return min(max(k * MMR_FETCH_FACTOR, k), MAX_MMR_CANDIDATES)
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+def mmr_select(query_vector, candidate_vectors, k, mmr_lambda=0.7, dedup_threshold=DEFAULT_DEDUP_THRESHOLD):
+    """
+    Maximal Marginal Relevance: chọn lần lượt ứng viên có
+        lambda * sim(query, c) - (1 - lambda) * max(sim(c, đã chọn))
+    lớn nhất. lambda=1 -> giống kNN gốc, lambda nhỏ -> đa dạng hơn.
+    Ứng viên gần trùng (cosine >= dedup_threshold) với 1 sản phẩm đã chọn bị loại.
+    Trả về list chỉ số trong candidate_vectors, theo thứ tự chọn.
+    """
+    candidates = _normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    if len(candidates) == 0 or k <= 0: return []
+    relevance = candidates @ _normalize(np.asarray(query_vector, dtype=np.float32))
+    pairwise = candidates @ candidates.T # Tính 1 lần, mỗi bước chọn chỉ còn O(N)
+
+    max_similarity = np.zeros(len(candidates), dtype=np.float32)
+    available = np.ones(len(candidates), dtype=bool)
+    selected = []
+    while len(selected) < k and available.any():
+        scores = mmr_lambda * relevance - (1.0 - mmr_lambda) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        max_similarity = np.maximum(max_similarity, pairwise[best])
+        available &= max_similarity < dedup_threshold
+    return selected
+
+def diversify_hits(hits, query_vector, k, mmr_lambda, dedup_threshold=DEFAULT_DEDUP_THRESHOLD, vector_field="product_embedding"):
+    """ Sắp xếp lại hits [{_id, product, score}] bằng MMR; hits thiếu vector bị bỏ qua """
+    hits = [hit for hit in hits if hit['product'].get(vector_field)]
+    if not hits: return []
+    order = mmr_select(query_vector, [hit['product'][vector_field] for hit in hits], k, mmr_lambda, dedup_threshold)
+    return [hits[i] for i in order]
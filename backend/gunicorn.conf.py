@@ -0,0 +1,32 @@
+# gunicorn.conf.py (Chế độ nhiều worker: gunicorn + UvicornWorker, chia sẻ model qua copy-on-write)
+# Chạy: gunicorn -c gunicorn.conf.py app.main:app
+import gc
+import multiprocessing
+import os
+
+workers = int(os.getenv("WEB_CONCURRENCY", max(1, multiprocessing.cpu_count() // 2)))
+os.environ["WEB_CONCURRENCY"] = str(workers) # App (nạp sau config) biết đang chạy nhiều worker
+worker_class = "uvicorn.workers.UvicornWorker"
+bind = os.getenv("BIND", "0.0.0.0:8000")
+timeout = int(os.getenv("WORKER_TIMEOUT", 120))
+keepalive = 5
+
+# Nạp app (model embedding, danh sách category...) 1 lần ở master rồi fork:
+# các worker dùng chung trang bộ nhớ của trọng số model (copy-on-write) thay vì mỗi worker 1 bản.
+preload_app = True
+
+# Mỗi worker dùng 1 phần CPU cho torch, tránh N worker x M thread tranh nhau (oversubscription)
+TORCH_THREADS_PER_WORKER = int(os.getenv("TORCH_NUM_THREADS", max(1, multiprocessing.cpu_count() // workers)))
+
+def pre_fork(server, worker):
+    # Đưa các object đã nạp vào vùng "permanent" của GC: GC không ghi vào header của chúng
+    # -> không làm bẩn (copy) các trang bộ nhớ dùng chung sau khi fork
+    gc.freeze()
+
+def post_fork(server, worker):
+    import torch
+    torch.set_num_threads(TORCH_THREADS_PER_WORKER)
+    # Kết nối HTTP tới ES tạo ở master không được dùng chung giữa các process -> tạo lại
+    from app.es_client import es_client
+    if es_client is not None: es_client.reconnect()
+    server.log.info(f"Worker {worker.pid}: torch threads={TORCH_THREADS_PER_WORKER}")
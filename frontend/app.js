@@ -1,6 +1,8 @@
 // app.js (Đã thêm logic chuyển Tab và nút Tải thêm)
 const API_URL = 'http://localhost:8000';
 const RESULTS_PER_PAGE = 20; // Số sản phẩm tải mỗi lần
+// ID riêng cho mỗi tab: backend dùng để hủy các lượt tìm kiếm cũ khi người dùng gửi lượt mới
+const CLIENT_ID = (window.crypto && crypto.randomUUID) ? crypto.randomUUID() : String(Math.random()).slice(2);
 
 // === BIẾN TOÀN CỤC ĐỂ THEO DÕI SỐ TRANG ===
 let currentProductPage = 1;
@@ -218,7 +220,8 @@ async function fetchKeywordSearch(queryText, category) {
         if (category) params.append('category', category);
         const url = `${API_URL}/search-keyword?${params.toString()}`;
 
-        const response = await fetch(url);
+        const response = await fetch(url, { headers: { 'X-Client-Id': CLIENT_ID } });
+        if (response.status === 409) return; // Đã có lượt tìm kiếm mới hơn, bỏ kết quả cũ
         if (!response.ok) throw await createApiError(response, 'Tìm kiếm từ khóa thất bại');
 
         const results = await response.json();
@@ -245,7 +248,9 @@ async function fetchSemanticSuggestions(queryText, category) {
         if (category) params.append('category', category);
         const url = `${API_URL}/search-semantic-suggestions?${params.toString()}`;
 
-        const response = await fetch(url);
+        // Gợi ý semantic là phần phụ: đánh dấu ưu tiên thấp để backend bỏ qua trước khi quá tải
+        const response = await fetch(url, { headers: { 'X-Client-Id': CLIENT_ID, 'X-Priority': 'low' } });
+        if (response.status === 409) return; // Đã có lượt tìm kiếm mới hơn, bỏ kết quả cũ
         if (!response.ok) throw await createApiError(response, 'Lấy gợi ý thất bại');
 
         const suggestions = await response.json();
@@ -3,6 +3,10 @@ import subprocess
 import sys
 import os
 import time
+import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import requests
 from requests.exceptions import ConnectionError
 from dotenv import load_dotenv
@@ -11,64 +15,190 @@ import signal
 load_dotenv()
 
 ES_HOST_URL = os.getenv("ELASTICSEARCH_HOST", "http://localhost:9200")
+INDEX_NAME = os.getenv("INDEX_NAME", "products")
 PYTHON_EXE = sys.executable if sys.executable else "python"
 SCRIPT_PREPROCESS = "scripts/preprocess_csv.py"
 SCRIPT_EMBED = "scripts/embed_to_json.py"
 SCRIPT_IMPORT = "scripts/import_to_elasticsearch.py"
+RAW_INPUT_FILE = os.getenv("RAW_CSV_FILE", "data/raw_products.csv")
+PREPROCESSED_FILE = os.getenv("PREPROCESSED_JSON_FILE", "data/mock_products.json")
 EMBED_CACHE_FILE = os.getenv("EMBEDDED_JSON_FILE", "data/mock_products_with_embedding.json")
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "data/embedding_cache.sqlite")
+# Phép chiếu giảm chiều (embed fit, import dùng): chỉ là đầu ra/đầu vào khi VECTOR_PROJECTION khác 'none'
+PROJECTION_FILES = [os.getenv("PROJECTION_FILE", "data/projection.npz")] if os.getenv("VECTOR_PROJECTION", "none") != "none" else []
+# Lưu fingerprint đầu vào/đầu ra của từng bước để bỏ qua bước không đổi
+PIPELINE_STATE_FILE = os.getenv("PIPELINE_STATE_FILE", "data/.pipeline_state.json")
 
-def run_command(command, description, exit_on_error=True):
-    print(f"\n🚀 [ĐANG CHẠY] {description}...")
-    print(f"   Lệnh: {' '.join(command)}")
+_print_lock = threading.Lock()
+
+def log(message, **kwargs):
+    """ print an toàn khi nhiều bước chạy song song (không bị xen giữa dòng) """
+    with _print_lock: print(message, **kwargs)
+
+def run_command(command, description, exit_on_error=True, prefix=None):
+    """ Chạy lệnh con, stream stdout/stderr theo từng dòng (không buffer toàn bộ output trong bộ nhớ) """
+    log(f"\n🚀 [ĐANG CHẠY] {description}...")
+    log(f"   Lệnh: {' '.join(command)}")
     env = os.environ.copy()
     env['PYTHONIOENCODING'] = 'utf-8'
+    env['PYTHONUNBUFFERED'] = '1'
+    prefix = f"   [{prefix}] " if prefix else "   | "
     try:
-        result = subprocess.run(
-            command, check=True, capture_output=True, text=True, encoding='utf-8', env=env
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            text=True, encoding='utf-8', errors='replace', env=env
         )
-        if result.stdout: print("   [OUTPUT]:\n---\n" + result.stdout.strip() + "\n---")
-        if result.stderr:
-            stderr_output = result.stderr.strip()
-            if stderr_output and "the attribute `version` is obsolete" not in stderr_output:
-                print(f"   [LOG Phụ/Cảnh báo]: {stderr_output}")
-        print(f"✅ [THÀNH CÔNG] {description}")
+        tail = [] # Giữ vài dòng cuối để in lại khi lỗi
+        for line in process.stdout:
+            line = line.rstrip()
+            if not line or "the attribute `version` is obsolete" in line: continue
+            log(prefix + line)
+            tail = (tail + [line])[-20:]
+        return_code = process.wait()
+        if return_code != 0:
+            raise subprocess.CalledProcessError(return_code, command, output="\n".join(tail))
+        log(f"✅ [THÀNH CÔNG] {description}")
         return True
     except subprocess.CalledProcessError as e:
-        print(f"❌ [LỖI NGHIÊM TRỌNG] {description} thất bại.")
-        print(f"   Lệnh: {' '.join(e.cmd)}")
-        print(f"   Exit Code: {e.returncode}")
-        if e.stdout: print(f"   STDOUT: {e.stdout.strip()}")
-        if e.stderr: print(f"   STDERR: {e.stderr.strip()}")
+        log(f"❌ [LỖI NGHIÊM TRỌNG] {description} thất bại.")
+        log(f"   Lệnh: {' '.join(e.cmd)}")
+        log(f"   Exit Code: {e.returncode}")
+        if e.output: log(f"   OUTPUT (cuối): {e.output.strip()}")
         if exit_on_error: raise
         else: return False
     except FileNotFoundError:
-         print(f"❌ [LỖI] Không tìm thấy lệnh: {command[0]}.")
+         log(f"❌ [LỖI] Không tìm thấy lệnh: {command[0]}.")
          if exit_on_error: raise
          else: return False
 
+# === DAG CÁC BƯỚC PIPELINE ===
+def file_fingerprint(path):
+    """ Fingerprint rẻ của 1 file: (đường dẫn, kích thước, mtime). File không tồn tại -> None """
+    try:
+        st = os.stat(path)
+        return [path, st.st_size, st.st_mtime_ns]
+    except OSError: return None
+
+def load_pipeline_state():
+    try:
+        with open(PIPELINE_STATE_FILE, 'r', encoding='utf-8') as f: return json.load(f)
+    except (OSError, json.JSONDecodeError): return {}
+
+def save_pipeline_state(state):
+    os.makedirs(os.path.dirname(PIPELINE_STATE_FILE) or '.', exist_ok=True)
+    with open(PIPELINE_STATE_FILE, 'w', encoding='utf-8') as f: json.dump(state, f, indent=2)
+
+class Stage:
+    """
+    Một bước trong DAG.
+    - action: hàm không tham số, trả về True nếu thành công
+    - deps: tên các bước phải xong trước
+    - inputs/outputs/params: dùng để tính fingerprint. Bước có `outputs` được bỏ qua khi
+      fingerprint đầu vào không đổi và đầu ra vẫn khớp lần chạy trước.
+    - is_valid: kiểm tra bổ sung trước khi bỏ qua (vd: index ES còn tồn tại)
+    """
+    def __init__(self, name, description, action, deps=(), inputs=(), outputs=(), params=None, is_valid=None):
+        self.name = name
+        self.description = description
+        self.action = action
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.is_valid = is_valid
+
+    def input_fingerprint(self):
+        content = json.dumps({"inputs": [file_fingerprint(p) for p in self.inputs], "params": self.params}, sort_keys=True)
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+    def output_fingerprint(self):
+        return [file_fingerprint(p) for p in self.outputs]
+
+    def is_up_to_date(self, state):
+        if not self.outputs: return False
+        previous = state.get(self.name)
+        if not previous or None in self.output_fingerprint(): return False
+        if previous.get("inputs") != self.input_fingerprint(): return False
+        if previous.get("outputs") != self.output_fingerprint(): return False
+        return self.is_valid() if self.is_valid else True
+
+def run_dag(stages, force=False, max_workers=4):
+    """
+    Chạy các bước theo thứ tự phụ thuộc; các bước độc lập chạy song song.
+    Trả về dict {tên: {"status": ok|skipped|failed|blocked, "seconds": ...}}
+    """
+    state = {} if force else load_pipeline_state()
+    pending = {stage.name: stage for stage in stages}
+    results = {}
+    running = {}
+
+    def execute(stage):
+        start = time.time()
+        if stage.is_up_to_date(state):
+            log(f"\n⏭️  [BỎ QUA] {stage.description} (đầu vào không đổi).")
+            return "skipped", time.time() - start
+        fingerprint = stage.input_fingerprint() # Tính trước khi chạy: đầu vào có thể đổi trong lúc chạy
+        if not stage.action(): raise Exception(f"{stage.description} lỗi.")
+        if stage.outputs:
+            with _print_lock:
+                state[stage.name] = {"inputs": fingerprint, "outputs": stage.output_fingerprint()}
+                save_pipeline_state(state)
+        return "ok", time.time() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, stage in list(pending.items()):
+                dep_status = [results.get(dep, {}).get("status") for dep in stage.deps if dep in results or dep in pending or dep in running.values()]
+                if any(status in ("failed", "blocked") for status in dep_status):
+                    results[name] = {"status": "blocked", "seconds": 0.0}
+                    del pending[name]
+                elif all(status in ("ok", "skipped") for status in dep_status):
+                    running[pool.submit(execute, stage)] = name
+                    del pending[name]
+            if not running: continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    status, seconds = future.result()
+                    results[name] = {"status": status, "seconds": seconds}
+                except Exception as e:
+                    log(f"❌ [{name}] {e}")
+                    results[name] = {"status": "failed", "seconds": 0.0}
+    return results
+
+def print_stage_summary(stages, results):
+    icons = {"ok": "✅", "skipped": "⏭️ ", "failed": "❌", "blocked": "⛔"}
+    log("\n--- ⏱️ THỜI GIAN TỪNG BƯỚC ---")
+    for stage in stages:
+        result = results.get(stage.name, {"status": "blocked", "seconds": 0.0})
+        log(f"  {icons[result['status']]} {stage.description:<35} {result['status']:<8} {result['seconds']:8.2f}s")
+
 def wait_for_elasticsearch(url, timeout):
-    print(f"⏱️ [ĐANG CHỜ] Elasticsearch tại {url} (timeout: {timeout}s)...")
+    """ Chạy song song với bước embed: mỗi lần poll in 1 dòng đầy đủ qua log() để không chen giữa log của bước khác """
+    log(f"⏱️ [ĐANG CHỜ] Elasticsearch tại {url} (timeout: {timeout}s)...")
+    prefix = "   [es_ready] "
     start_time = time.time()
     while True:
+        elapsed = time.time() - start_time
         try:
             response = requests.get(url + "/_cluster/health?wait_for_status=yellow&timeout=5s", timeout=10)
             response.raise_for_status() # Check for HTTP errors
             health = response.json().get('status')
             if health in ('yellow', 'green'):
-                print(f"\n✅ [SẴN SÀNG] Elasticsearch ({health}) sau {time.time() - start_time:.2f}s!")
+                log(f"✅ [SẴN SÀNG] Elasticsearch ({health}) sau {time.time() - start_time:.2f}s!")
                 return True
             else:
-                 print(f" ({health})", end="", flush=True)
-        except ConnectionError: print("c", end="", flush=True)
-        except requests.Timeout: print("t", end="", flush=True)
-        except requests.RequestException as e: print(f" E({e.response.status_code if e.response else 'N/A'})", end="", flush=True) # Print HTTP error code
-        except Exception as e: print(f"\n   ⚠️ Lỗi polling ES: {e}")
+                log(f"{prefix}Trạng thái cluster: {health} ({elapsed:.0f}s)")
+        except ConnectionError: log(f"{prefix}Chưa kết nối được ({elapsed:.0f}s)")
+        except requests.Timeout: log(f"{prefix}Hết thời gian chờ phản hồi ({elapsed:.0f}s)")
+        except requests.RequestException as e: log(f"{prefix}Lỗi HTTP {e.response.status_code if e.response else 'N/A'} ({elapsed:.0f}s)")
+        except Exception as e: log(f"{prefix}⚠️ Lỗi polling ES: {e}")
 
         if time.time() - start_time > timeout:
-            print(f"\n❌ [LỖI] Hết {timeout}s chờ Elasticsearch.")
+            log(f"❌ [LỖI] Hết {timeout}s chờ Elasticsearch.")
             return False
 
-        print(".", end="", flush=True)
         time.sleep(3)
 
 def setup_argparse():
@@ -85,8 +215,83 @@ def setup_argparse():
     pipeline_group.add_argument("--skip-embed", action="store_true", help="Bỏ qua embedding.")
     pipeline_group.add_argument("--only-embed", action="store_true", help="Chỉ chạy embedding.")
     pipeline_group.add_argument("--force-embed", action="store_true", help="Ép tạo lại embedding.")
+    pipeline_group.add_argument("--force", action="store_true", help="Chạy lại mọi bước, bỏ qua cache fingerprint.")
+    pipeline_group.add_argument("--jobs", type=int, default=4, help="Số bước tối đa chạy song song.")
     return parser.parse_args()
 
+def es_index_has_documents():
+    """ Bỏ qua bước import chỉ khi index vẫn còn dữ liệu (vd: không bị 'down -v') """
+    try:
+        response = requests.get(f"{ES_HOST_URL}/{INDEX_NAME}/_count", timeout=5)
+        return response.ok and response.json().get('count', 0) > 0
+    except requests.RequestException: return False
+
+def wait_for_es_stage(timeout):
+    if wait_for_elasticsearch(ES_HOST_URL, timeout): return True
+    log("❌ ES không sẵn sàng. Kiểm tra logs: docker-compose logs elasticsearch")
+    return False
+
+def check_es_connection():
+    log("   Kiểm tra kết nối ES...")
+    try: requests.get(ES_HOST_URL, timeout=5).raise_for_status()
+    except Exception as e: log(f"   ⚠️ Lỗi kết nối ES: {e}")
+    return True # Chỉ cảnh báo, giống hành vi cũ
+
+def build_stages(args):
+    """
+    DAG:  docker_build -> docker_up -> es_ready ─┐
+          preprocess -> embed ───────────────────┴-> import
+    Embedding chạy song song với việc khởi động Docker/chờ ES.
+    """
+    only_mode = args.only_preprocess or args.only_embed
+    stages = []
+    if not only_mode:
+        if not args.no_docker:
+            stages.append(Stage("docker_build", "🏗️  Build Docker images",
+                                lambda: run_command(["docker-compose", "build"], "🏗️  Build Docker images", prefix="docker")))
+            stages.append(Stage("docker_up", "🐳 Khởi động Docker containers",
+                                lambda: run_command(["docker-compose", "up", "-d"], "🐳 Khởi động Docker containers", prefix="docker"),
+                                deps=["docker_build"]))
+            stages.append(Stage("es_ready", "⏱️  Chờ Elasticsearch",
+                                lambda: wait_for_es_stage(args.timeout_es), deps=["docker_up"]))
+        else:
+            log("🚫 [BỎ QUA] Docker.")
+            stages.append(Stage("es_ready", "🔌 Kiểm tra kết nối ES", check_es_connection))
+
+    if not args.skip_preprocess:
+        stages.append(Stage(
+            "preprocess", "📑 (1/3) Preprocess",
+            lambda: run_command([PYTHON_EXE, SCRIPT_PREPROCESS], "📑 (1/3) Preprocess", prefix="preprocess"),
+            inputs=[RAW_INPUT_FILE, SCRIPT_PREPROCESS], outputs=[PREPROCESSED_FILE],
+            params={k: os.getenv(k) for k in ("PREPROCESS_CHUNKSIZE", "PREPROCESS_WRITE_CSV")}
+        ))
+    else: log("🚫 [BỎ QUA] Preprocess.")
+    if args.only_preprocess: return stages
+
+    if not args.skip_embed:
+        stages.append(Stage(
+            "embed", "🧠 (2/3) Embedding",
+            lambda: run_command([PYTHON_EXE, SCRIPT_EMBED], "🧠 (2/3) Embedding", prefix="embed"),
+            deps=["preprocess"], inputs=[PREPROCESSED_FILE, SCRIPT_EMBED], outputs=[EMBED_CACHE_FILE, *PROJECTION_FILES],
+            params={k: os.getenv(k) for k in ("MODEL_NAME", "MODEL_REVISION", "EMBEDDING_CACHE_DB",
+                                              "VECTOR_PROJECTION", "PROJECTION_DIM", "PROJECTION_FIT_SAMPLES")}
+        ))
+    else: log("🚫 [BỎ QUA] Embedding.")
+    if args.only_embed: return stages
+
+    stages.append(Stage(
+        "import", "🚚 (3/3) Import to ES",
+        lambda: run_command([PYTHON_EXE, SCRIPT_IMPORT], "🚚 (3/3) Import to ES", prefix="import"),
+        deps=["embed", "es_ready"], inputs=[EMBED_CACHE_FILE, *PROJECTION_FILES, SCRIPT_IMPORT],
+        # Đầu ra của import nằm trong ES: dùng state file làm "output" và kiểm tra index còn dữ liệu
+        outputs=[EMBED_CACHE_FILE],
+        # Các biến quyết định mapping/settings của index: đổi -> phải import lại
+        params={"ES_HOST": ES_HOST_URL, "INDEX_NAME": INDEX_NAME,
+                **{k: os.getenv(k) for k in ("VECTOR_DIM", "VECTOR_PROJECTION", "PROJECTION_INDEX", "KEYWORD_ANALYSIS")}},
+        is_valid=es_index_has_documents
+    ))
+    return stages
+
 def main():
     args = setup_argparse()
     start_pipeline_time = time.time()
@@ -95,39 +300,20 @@ def main():
     try:
         if args.force_embed:
             print("🔥 [FORCE-EMBED] Đang xóa cache embedding...")
-            if os.path.exists(EMBED_CACHE_FILE):
-                try:
-                    os.remove(EMBED_CACHE_FILE)
-                    print(f"   ✅ Đã xóa: {EMBED_CACHE_FILE}")
-                except Exception as e: print(f"   ⚠️ Lỗi xóa cache: {e}")
-            else: print(f"   ℹ️ Cache không tồn tại: {EMBED_CACHE_FILE}")
+            for cache_file in filter(None, [EMBED_CACHE_FILE, EMBEDDING_CACHE_DB]):
+                if os.path.exists(cache_file):
+                    try:
+                        os.remove(cache_file)
+                        print(f"   ✅ Đã xóa: {cache_file}")
+                    except Exception as e: print(f"   ⚠️ Lỗi xóa cache: {e}")
+                else: print(f"   ℹ️ Cache không tồn tại: {cache_file}")
 
-        if not args.no_docker:
-            print("\n--- Bước 1: Khởi động Docker ---")
-            if not run_command(["docker-compose", "build"], "🏗️  Build Docker images"): raise Exception("Build lỗi.")
-            if not run_command(["docker-compose", "up", "-d"], "🐳 Khởi động Docker containers"): raise Exception("Up lỗi.")
-            if not wait_for_elasticsearch(ES_HOST_URL, args.timeout_es):
-                 print("❌ ES không sẵn sàng. Kiểm tra logs: docker-compose logs elasticsearch")
-                 sys.exit(1)
-        else:
-            print("🚫 [BỎ QUA] Docker.")
-            print("   Kiểm tra kết nối ES...")
-            try: requests.get(ES_HOST_URL, timeout=5).raise_for_status()
-            except Exception as e: print(f"   ⚠️ Lỗi kết nối ES: {e}")
-
-        print("\n--- Bước 2: Chạy Data Pipeline ---")
-        if not args.skip_preprocess:
-            if not run_command([PYTHON_EXE, SCRIPT_PREPROCESS], "📑 (1/3) Preprocess"): raise Exception("Preprocess lỗi.")
-        else: print("🚫 [BỎ QUA] Preprocess.")
-        if args.only_preprocess: sys.exit(0) # Thoát sớm
-
-        if not args.skip_embed:
-            if not run_command([PYTHON_EXE, SCRIPT_EMBED], "🧠 (2/3) Embedding"): raise Exception("Embedding lỗi.")
-        else: print("🚫 [BỎ QUA] Embedding.")
-        if args.only_embed: sys.exit(0) # Thoát sớm
-
-        print("⏩ (3/3) Chạy Import...")
-        if not run_command([PYTHON_EXE, SCRIPT_IMPORT], "🚚 (3/3) Import to ES"): raise Exception("Import lỗi.")
+        print("\n--- Chạy Pipeline (DAG, song song khi có thể) ---")
+        stages = build_stages(args)
+        results = run_dag(stages, force=args.force, max_workers=args.jobs)
+        print_stage_summary(stages, results)
+        failed = [name for name, result in results.items() if result["status"] in ("failed", "blocked")]
+        if failed: raise Exception(f"Các bước lỗi/không chạy được: {', '.join(failed)}")
 
         print("\n" + "="*50 + "\n--- 🎉 QUY TRÌNH HOÀN TẤT THÀNH CÔNG ---\n" + "="*50)
 
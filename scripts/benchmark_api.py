@@ -0,0 +1,217 @@
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+import requests
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+API_URL = os.getenv("API_URL", "http://localhost:8000")
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend")
+# Truy vấn mẫu cho benchmark throughput (thêm hậu tố để không bị gộp bởi single-flight)
+SAMPLE_QUERIES = ["laptop mỏng nhẹ", "điện thoại pin trâu", "tai nghe chống ồn", "bàn phím cơ", "máy ảnh du lịch"]
+
+def percentile_ms(latencies, p):
+    return float(np.percentile(np.asarray(latencies) * 1000, p)) if latencies else 0.0
+
+def print_latency_row(label, latencies):
+    print(f"  {label:<28} n={len(latencies):<5} p50={percentile_ms(latencies, 50):7.1f}ms  "
+          f"p95={percentile_ms(latencies, 95):7.1f}ms  mean={np.mean(latencies) * 1000 if latencies else 0:7.1f}ms")
+
+def sample_products(session, count):
+    """ Lấy `count` sản phẩm đầu tiên qua /products """
+    products, page = [], 1
+    while len(products) < count:
+        resp = session.get(f"{API_URL}/products", params={"page": page, "size": 100}, timeout=30)
+        resp.raise_for_status()
+        data = resp.json().get("data", [])
+        if not data: break
+        products.extend(data)
+        page += 1
+    return products[:count]
+
+def sample_product_ids(session, count):
+    return [p["_id"] for p in sample_products(session, count)]
+
+def timed_get(session, url, params=None):
+    start = time.perf_counter()
+    resp = session.get(url, params=params, timeout=60)
+    elapsed = time.perf_counter() - start
+    resp.raise_for_status()
+    return elapsed, resp.json()
+
+# === RERANK: kNN gốc vs kNN + MMR ===
+def diversity_stats(recommendations):
+    products = [r["product"] for r in recommendations]
+    return len({p.get("category") for p in products}), len(products) - len({p.get("name") for p in products})
+
+def bench_rerank(session, args):
+    ids = sample_product_ids(session, args.samples)
+    if not ids:
+        print("❌ Không lấy được sản phẩm nào để benchmark.")
+        sys.exit(1)
+    print(f"\n⚙️ Benchmark /recommend: kNN gốc vs MMR (lambda={args.mmr_lambda}) trên {len(ids)} sản phẩm...")
+    results = {}
+    for label, params in (("kNN gốc", None), (f"MMR lambda={args.mmr_lambda}", {"mmr_lambda": args.mmr_lambda})):
+        latencies, categories, duplicates = [], [], []
+        for _ in range(args.repeat):
+            for doc_id in ids:
+                elapsed, body = timed_get(session, f"{API_URL}/recommend/{doc_id}", params)
+                latencies.append(elapsed)
+                n_categories, n_duplicates = diversity_stats(body.get("recommendations", []))
+                categories.append(n_categories)
+                duplicates.append(n_duplicates)
+        results[label] = latencies
+        print_latency_row(label, latencies)
+        print(f"  {'':<28} category khác nhau/list={np.mean(categories):.2f}  tên trùng/list={np.mean(duplicates):.2f}")
+
+    (_, base), (_, reranked) = results.items()
+    overhead = percentile_ms(reranked, 95) - percentile_ms(base, 95)
+    status = "✅" if overhead <= args.budget_ms else "⚠️ VƯỢT"
+    print(f"\n  {status} Chênh lệch p95: {overhead:+.1f}ms (ngân sách {args.budget_ms}ms)")
+
+# === KEYWORD: truy vấn cũ (2 match/từ) vs multi_match trên field gốc + .folded ===
+def strip_diacritics(text):
+    text = text.replace("đ", "d").replace("Đ", "D")
+    return "".join(c for c in unicodedata.normalize("NFD", text) if unicodedata.category(c) != "Mn")
+
+def bench_keyword(session, args):
+    """
+    Relevance gần đúng không cần nhãn: truy vấn = vài từ đầu tên sản phẩm (có dấu / bỏ dấu),
+    đo sản phẩm gốc có nằm trong top-k không (hit@k) và thứ hạng của nó (MRR).
+    """
+    products = [p for p in sample_products(session, args.samples) if p.get("name")]
+    if not products:
+        print("❌ Không lấy được sản phẩm nào để benchmark.")
+        sys.exit(1)
+    queries = []
+    for product in products:
+        query = " ".join(product["name"].split()[:args.query_words])
+        queries.append(("có dấu", product["_id"], query))
+        queries.append(("không dấu", product["_id"], strip_diacritics(query)))
+    print(f"\n⚙️ Benchmark /search-keyword: legacy vs multi_match trên {len(products)} sản phẩm (top-{args.top_k})...")
+    for query_mode in ("legacy", "multi_match"):
+        for variant in ("có dấu", "không dấu"):
+            latencies, hits_at_k, reciprocal_ranks = [], [], []
+            for _ in range(args.repeat):
+                for query_variant, doc_id, query in queries:
+                    if query_variant != variant: continue
+                    elapsed, results = timed_get(session, f"{API_URL}/search-keyword",
+                                                 {"query": query, "size": args.top_k, "query_mode": query_mode})
+                    latencies.append(elapsed)
+                    ranked_ids = [r["_id"] for r in results]
+                    rank = ranked_ids.index(doc_id) + 1 if doc_id in ranked_ids else None
+                    hits_at_k.append(1.0 if rank else 0.0)
+                    reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+            print_latency_row(f"{query_mode} / {variant}", latencies)
+            print(f"  {'':<28} hit@{args.top_k}={np.mean(hits_at_k):.3f}  MRR={np.mean(reciprocal_ranks):.3f}")
+
+# === THROUGHPUT: số request/giây theo số worker ===
+def build_request(endpoint, base_url, i, product_ids):
+    query = f"{SAMPLE_QUERIES[i % len(SAMPLE_QUERIES)]} {i}"
+    if endpoint == "semantic": return f"{base_url}/search-semantic-suggestions", {"query": query}
+    if endpoint == "keyword": return f"{base_url}/search-keyword", {"query": query}
+    return f"{base_url}/recommend/{product_ids[i % len(product_ids)]}", None
+
+def run_load(base_url, endpoint, concurrency, duration, product_ids):
+    """ `concurrency` client song song (mỗi client 1 X-Client-Id riêng) gửi request liên tục trong `duration` giây """
+    latencies, status_counts, lock = [], {}, threading.Lock()
+    counter = iter(range(10 ** 9))
+    deadline = time.perf_counter() + duration
+
+    def client():
+        session = requests.Session()
+        session.headers["X-Client-Id"] = uuid.uuid4().hex
+        while time.perf_counter() < deadline:
+            url, params = build_request(endpoint, base_url, next(counter), product_ids)
+            start = time.perf_counter()
+            try: status = session.get(url, params=params, timeout=60).status_code
+            except requests.RequestException: status = "conn_error"
+            elapsed = time.perf_counter() - start
+            with lock:
+                status_counts[status] = status_counts.get(status, 0) + 1
+                if status == 200: latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return latencies, status_counts
+
+def launch_server(workers, port):
+    """ Chạy backend bằng gunicorn (gunicorn.conf.py) với `workers` worker trên cổng `port` """
+    env = {**os.environ, "WEB_CONCURRENCY": str(workers)}
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "app.main:app", "--bind", f"127.0.0.1:{port}"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(180):
+        if process.poll() is not None: raise RuntimeError(f"gunicorn ({workers} worker) thoát với mã {process.returncode}")
+        try:
+            if requests.get(base_url, timeout=2).ok: return process, base_url
+        except requests.RequestException: pass
+        time.sleep(1)
+    process.terminate()
+    raise RuntimeError(f"gunicorn ({workers} worker) không sẵn sàng sau 180s")
+
+def bench_throughput(session, args):
+    worker_counts = [int(w) for w in args.workers.split(",")] if args.workers else [None]
+    product_ids = sample_product_ids(session, args.samples) if args.endpoint == "recommend" else []
+    if args.endpoint == "recommend" and not product_ids:
+        print("❌ Không lấy được sản phẩm nào để benchmark.")
+        sys.exit(1)
+    print(f"\n⚙️ Benchmark throughput '{args.endpoint}': {args.concurrency} client, {args.duration}s mỗi cấu hình...")
+    baseline = None
+    for workers in worker_counts:
+        process, base_url = (None, API_URL) if workers is None else launch_server(workers, args.port)
+        try:
+            run_load(base_url, args.endpoint, args.concurrency, min(3, args.duration), product_ids) # Khởi động (warm-up)
+            latencies, status_counts = run_load(base_url, args.endpoint, args.concurrency, args.duration, product_ids)
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+        rps = len(latencies) / args.duration
+        baseline = baseline or rps
+        label = f"{workers} worker" if workers else base_url
+        print(f"  {label:<22} {rps:8.1f} req/s  (x{rps / baseline if baseline else 0:.2f})  "
+              f"p50={percentile_ms(latencies, 50):7.1f}ms  p95={percentile_ms(latencies, 95):7.1f}ms  status={status_counts}")
+
+def setup_argparse():
+    parser = argparse.ArgumentParser(description="Benchmark các endpoint của backend API.")
+    parser.add_argument("mode", choices=["rerank", "keyword", "throughput"], help="Kịch bản benchmark.")
+    parser.add_argument("--samples", type=int, default=50, help="Số sản phẩm/truy vấn mẫu.")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần lặp mỗi mẫu.")
+    parser.add_argument("--mmr-lambda", type=float, default=0.7, help="lambda cho MMR (rerank).")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("RERANK_BUDGET_MS", 20)), help="Ngân sách độ trễ thêm (p95) cho rerank.")
+    parser.add_argument("--query-words", type=int, default=3, help="Số từ đầu tên sản phẩm dùng làm truy vấn (keyword).")
+    parser.add_argument("--top-k", type=int, default=10, help="Top-k để tính hit@k/MRR (keyword).")
+    parser.add_argument("--endpoint", choices=["semantic", "keyword", "recommend"], default="semantic", help="Endpoint cho throughput.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Số client song song (throughput).")
+    parser.add_argument("--duration", type=float, default=20, help="Thời gian đo mỗi cấu hình, giây (throughput).")
+    parser.add_argument("--workers", help="Danh sách số worker, vd '1,2,4': tự chạy gunicorn cho từng giá trị (throughput).")
+    parser.add_argument("--port", type=int, default=8100, help="Cổng cho gunicorn tự chạy (throughput --workers).")
+    return parser.parse_args()
+
+def main():
+    args = setup_argparse()
+    session = requests.Session()
+    # Throughput với --workers tự chạy server riêng; chỉ cần API_URL khi lấy ID sản phẩm mẫu
+    needs_api = not (args.mode == "throughput" and args.workers and args.endpoint != "recommend")
+    if needs_api:
+        try: session.get(API_URL, timeout=5).raise_for_status()
+        except Exception as e:
+            print(f"❌ Không kết nối được API tại {API_URL}: {e}")
+            sys.exit(1)
+    if args.mode == "rerank": bench_rerank(session, args)
+    elif args.mode == "keyword": bench_keyword(session, args)
+    elif args.mode == "throughput": bench_throughput(session, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Đọc/ghi dữ liệu sản phẩm giữa các bước pipeline (preprocess -> embed -> import).
+Định dạng chọn theo đuôi file:
+- .json: mảng JSON (mặc định, tương thích cũ)
+- .jsonl / .ndjson: mỗi dòng 1 sản phẩm
+- .parquet: Arrow/Parquet dạng cột, embedding lưu ở cột fixed_size_list<float32>.
+  Mỗi bước chỉ đọc các cột cần thiết (vd: so sánh cache chỉ đọc 'id' + 'data_hash').
+"""
+import json
+import os
+import numpy as np
+
+EMBEDDING_COLUMN = 'product_embedding'
+
+def is_parquet(file_path):
+    return file_path.lower().endswith('.parquet')
+
+def is_json_lines(file_path):
+    return file_path.lower().endswith(('.jsonl', '.ndjson'))
+
+def read_products(file_path, columns=None, encoding='utf-8-sig'):
+    """ Đọc toàn bộ sản phẩm thành list dict. Với JSON vẫn phải parse cả file rồi mới lọc cột. """
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+        return pq.read_table(file_path, columns=columns).to_pylist()
+    with open(file_path, 'r', encoding=encoding) as f:
+        if is_json_lines(file_path): products = [json.loads(line) for line in f if line.strip()]
+        else: products = json.load(f)
+    if columns: products = [{key: product.get(key) for key in columns} for product in products]
+    return products
+
+def read_table(file_path, columns=None, filter_ids=None):
+    """ Đọc file .parquet thành pyarrow.Table (chỉ các cột cần, có thể lọc theo 'id'). """
+    import pyarrow.parquet as pq
+    filters = [('id', 'in', list(filter_ids))] if filter_ids is not None else None
+    return pq.read_table(file_path, columns=columns, filters=filters)
+
+def read_embeddings(file_path, columns=()):
+    """ Đọc cột embedding thành ma trận numpy (N x dim, float32) + các cột `columns` (dict tên cột -> list) """
+    if is_parquet(file_path):
+        table = read_table(file_path, columns=[*columns, EMBEDDING_COLUMN])
+        vectors = table.column(EMBEDDING_COLUMN).combine_chunks().flatten().to_numpy(zero_copy_only=False)
+        matrix = vectors.astype(np.float32).reshape(table.num_rows, -1)
+        return matrix, {name: table.column(name).to_pylist() for name in columns}
+    products = [p for p in read_products(file_path, columns=[*columns, EMBEDDING_COLUMN]) if p.get(EMBEDDING_COLUMN)]
+    matrix = np.asarray([p[EMBEDDING_COLUMN] for p in products], dtype=np.float32)
+    return matrix, {name: [p.get(name) for p in products] for name in columns}
+
+def count_products(file_path):
+    """ Số sản phẩm trong file. Với .parquet chỉ đọc metadata. """
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(file_path).metadata.num_rows
+    return len(read_products(file_path, columns=['id']))
+
+def iter_product_batches(file_path, exclude_columns=(), batch_size=1000):
+    """ Sinh từng lô list dict, bỏ các cột không cần (vd: 'data_hash' khi import). """
+    if is_parquet(file_path):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(file_path)
+        columns = [name for name in parquet_file.schema_arrow.names if name not in exclude_columns]
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pylist()
+        return
+    products = read_products(file_path)
+    for start in range(0, len(products), batch_size):
+        yield [{key: value for key, value in product.items() if key not in exclude_columns}
+               for product in products[start:start + batch_size]]
+
+def products_to_table(products, embeddings=None):
+    """
+    Chuyển list dict thành pyarrow.Table. `embeddings` (ma trận numpy N x dim) nếu có sẽ
+    được lưu thẳng thành cột fixed_size_list<float32>, không qua list Python.
+    """
+    import pyarrow as pa
+    if embeddings is None and products and EMBEDDING_COLUMN in products[0]:
+        embeddings = np.asarray([product[EMBEDDING_COLUMN] for product in products], dtype=np.float32)
+    rows = [{key: value for key, value in product.items() if key != EMBEDDING_COLUMN} for product in products]
+    table = pa.Table.from_pylist(rows)
+    if embeddings is not None:
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        vectors = pa.FixedSizeListArray.from_arrays(pa.array(embeddings.reshape(-1)), embeddings.shape[1])
+        table = table.append_column(EMBEDDING_COLUMN, vectors)
+    return table
+
+def write_table(table, file_path):
+    import pyarrow.parquet as pq
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    pq.write_table(table, file_path, compression='zstd')
+
+def write_products(products, file_path, embeddings=None):
+    """ Ghi list dict theo định dạng của đuôi file. """
+    if is_parquet(file_path):
+        write_table(products_to_table(products, embeddings), file_path)
+        return
+    if embeddings is not None:
+        for product, vector in zip(products, embeddings): product[EMBEDDING_COLUMN] = vector.tolist()
+    os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+    with open(file_path, 'w', encoding='utf-8') as f:
+        if is_json_lines(file_path):
+            for product in products: f.write(json.dumps(product, ensure_ascii=False) + '\n')
+        else:
+            json.dump(products, f, indent=4, ensure_ascii=False)
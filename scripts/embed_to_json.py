@@ -1,9 +1,14 @@
 import json
 import os
+import sys
 import hashlib
+import numpy as np
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
 from dotenv import load_dotenv
+from columnar_io import EMBEDDING_COLUMN, is_parquet, read_embeddings, read_products, read_table, products_to_table, write_products, write_table
+from embedding_cache import EmbeddingCache
+from projection import PROJECTION_METHODS, fit_projection
 
 load_dotenv()
 
@@ -11,18 +16,33 @@ load_dotenv()
 RAW_FILE_PATH = os.getenv('PREPROCESSED_JSON_FILE', 'data/mock_products.json')
 EMBED_FILE_PATH = os.getenv('EMBEDDED_JSON_FILE', 'data/mock_products_with_embedding.json')
 MODEL_NAME = os.getenv('MODEL_NAME', 'sentence-transformers/all-MiniLM-L6-v2')
+MODEL_REVISION = os.getenv('MODEL_REVISION') or None # Commit/tag trên HuggingFace Hub, None = mặc định
+MODEL_KEY = f"{MODEL_NAME}@{MODEL_REVISION or 'default'}"
+# Cache embedding theo (model, text), dùng chung giữa các lần chạy. Để trống để tắt.
+EMBEDDING_CACHE_DB = os.getenv('EMBEDDING_CACHE_DB', 'data/embedding_cache.sqlite')
+# Giảm số chiều vector cho index: 'none' | 'pca' | 'truncate'. File embedding vẫn giữ vector đầy đủ,
+# phép chiếu được fit ở đây, lưu ra PROJECTION_FILE và áp dụng khi import.
+VECTOR_PROJECTION = os.getenv('VECTOR_PROJECTION', 'none')
+PROJECTION_DIM = int(os.getenv('PROJECTION_DIM', 128))
+PROJECTION_FILE = os.getenv('PROJECTION_FILE', 'data/projection.npz')
+PROJECTION_FIT_SAMPLES = int(os.getenv('PROJECTION_FIT_SAMPLES', 50000)) # Số vector tối đa dùng để fit PCA
 # ------------------
 
 def _create_product_hash(product):
+    # Có MODEL_KEY: đổi model -> mọi dòng được làm mới (embedding lấy lại từ cache theo model mới)
     keys_to_hash = ['id', 'name', 'description', 'category', 'price', 'image_url']
-    content_string = "".join(str(product.get(key, '')) for key in keys_to_hash)
+    content_string = MODEL_KEY + "".join(str(product.get(key, '')) for key in keys_to_hash)
     return hashlib.md5(content_string.encode('utf-8')).hexdigest()
 
-def load_json_data(file_path, encoding='utf-8-sig'):
+def build_embedding_text(product):
+    """ Đoạn text được embed cho 1 sản phẩm. Backend (admin API) phải dùng đúng mẫu này. """
+    return f"Tên: {product.get('name','')}. Mô tả: {product.get('description','')}. Danh mục: {product.get('category','')}"
+
+def load_products(file_path, columns=None):
+    """ Đọc .json / .jsonl / .parquet. `columns` chỉ đọc các cột cần (hiệu quả với .parquet). """
     if not os.path.exists(file_path): return []
     try:
-        with open(file_path, 'r', encoding=encoding) as f:
-            return json.load(f)
+        return read_products(file_path, columns=columns)
     except json.JSONDecodeError:
         print(f"⚠️ Cảnh báo: File {file_path} lỗi JSON. Coi như rỗng.")
         return []
@@ -30,10 +50,10 @@ def load_json_data(file_path, encoding='utf-8-sig'):
         print(f"❌ Lỗi đọc file {file_path}: {e}")
         return []
 
-def load_model(model_name, device='cpu'):
+def load_model(model_name, device='cpu', revision=MODEL_REVISION):
     print(f"⏳ Đang tải mô hình '{model_name}' về (chỉ 1 lần nếu chưa có)...")
     try:
-        model = SentenceTransformer(model_name, device=device)
+        model = SentenceTransformer(model_name, device=device, revision=revision)
         print("✅ Tải mô hình thành công.")
         return model
     except Exception as e:
@@ -43,18 +63,21 @@ def load_model(model_name, device='cpu'):
 def main():
     print("\n--- Bắt đầu quy trình tạo Embedding ---")
 
-    raw_products = load_json_data(RAW_FILE_PATH)
+    raw_products = load_products(RAW_FILE_PATH)
     if not raw_products:
         print(f"❌ Lỗi: Không tìm thấy hoặc không đọc được file dữ liệu thô '{RAW_FILE_PATH}'. Dừng lại.")
         return
 
-    cached_products = load_json_data(EMBED_FILE_PATH)
+    # Cache dạng Parquet: chỉ đọc 'id' + 'data_hash' để so sánh, embedding của sản phẩm giữ nguyên
+    # được đọc sau (lọc theo id) và ghi thẳng dạng cột, không chuyển qua list Python.
+    columnar_cache = is_parquet(EMBED_FILE_PATH)
+    cached_products = load_products(EMBED_FILE_PATH, columns=['id', 'data_hash'] if columnar_cache else None)
     cached_map = {p.get('id'): p for p in cached_products if p.get('id')}
 
     products_to_keep = []
     products_to_embed = []
     texts_to_embed = []
-    stats = {"kept": 0, "updated": 0, "new": 0}
+    stats = {"kept": 0, "updated": 0, "new": 0, "cache_hits": 0}
     processed_ids = set()
 
     print(f"🔍 So sánh {len(raw_products)} sản phẩm thô với {len(cached_map)} sản phẩm đã cache...")
@@ -77,48 +100,124 @@ def main():
             stats["kept"] += 1
         else:
             product['data_hash'] = current_hash
-            content = f"Tên: {product.get('name','')}. Mô tả: {product.get('description','')}. Danh mục: {product.get('category','')}"
+            content = build_embedding_text(product)
             products_to_embed.append(product)
             texts_to_embed.append(content)
             stats["updated" if cached_product else "new"] += 1
 
     final_product_list = products_to_keep
-    model = None
+    embeddings = None
 
     if products_to_embed:
         print(f"\n⏳ Phát hiện {len(products_to_embed)} sản phẩm cần xử lý.")
-        model = load_model(MODEL_NAME)
-        if model is None:
-            print("❌ Không thể tiếp tục vì không tải được model.")
-            return
-
-        print(f"🧠 Bắt đầu tạo embedding...")
-        try:
-            embeddings = model.encode(texts_to_embed, show_progress_bar=True, device='cpu')
-            print("✅ Tạo embedding hoàn tất.")
+        embeddings = embed_texts(texts_to_embed, stats)
+        if embeddings is None: return
 
+        if not columnar_cache:
             for i, product in enumerate(products_to_embed):
-                product['product_embedding'] = embeddings[i].tolist()
+                product[EMBEDDING_COLUMN] = embeddings[i].tolist()
                 final_product_list.append(product)
-        except Exception as e:
-            print(f"❌ Lỗi nghiêm trọng khi tạo embedding: {e}")
-            # return # Cân nhắc dừng nếu lỗi
     else:
         print("\n✅ Không có sản phẩm nào cần tạo embedding mới.")
 
-    final_product_list.sort(key=lambda p: p.get('id', ''))
-
     try:
-        os.makedirs(os.path.dirname(EMBED_FILE_PATH), exist_ok=True)
-        with open(EMBED_FILE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(final_product_list, f, indent=4, ensure_ascii=False)
+        if columnar_cache:
+            saved_count = save_columnar(products_to_keep, products_to_embed, embeddings)
+        else:
+            final_product_list.sort(key=lambda p: p.get('id', ''))
+            write_products(final_product_list, EMBED_FILE_PATH) # .json (mảng) hoặc .jsonl
+            saved_count = len(final_product_list)
 
         print(f"\n--- ✅ HOÀN TẤT ---")
-        print(f"💾 Đã lưu {len(final_product_list)} sản phẩm vào '{EMBED_FILE_PATH}'")
-        print(f"📊 Thống kê: Giữ nguyên: {stats['kept']} | Cập nhật: {stats['updated']} | Mới: {stats['new']}")
+        print(f"💾 Đã lưu {saved_count} sản phẩm vào '{EMBED_FILE_PATH}'")
+        print(f"📊 Thống kê: Giữ nguyên: {stats['kept']} | Cập nhật: {stats['updated']} | Mới: {stats['new']} | Lấy từ cache embedding: {stats['cache_hits']}")
 
     except Exception as e:
         print(f"❌ Lỗi nghiêm trọng khi lưu file '{EMBED_FILE_PATH}': {e}")
+        return
+
+    # Fit lỗi -> exit khác 0 để run_all.py không ghi nhận bước embed là thành công
+    if VECTOR_PROJECTION != 'none' and not save_projection(): sys.exit(1)
+
+def save_projection():
+    """
+    Fit phép chiếu trên toàn bộ embedding (đầy đủ chiều) của file đầu ra, lưu ra PROJECTION_FILE.
+    Fit lại trên cùng dữ liệu cho cùng version -> import không phải đổi gì.
+    Lỗi -> xóa PROJECTION_FILE cũ (fit trên dữ liệu/model khác) và trả về False.
+    """
+    if VECTOR_PROJECTION not in PROJECTION_METHODS:
+        print(f"❌ VECTOR_PROJECTION='{VECTOR_PROJECTION}' không hợp lệ ({', '.join(PROJECTION_METHODS)}).")
+        remove_projection_file()
+        return False
+    try:
+        vectors, _ = read_embeddings(EMBED_FILE_PATH)
+        print(f"⏳ Fit phép chiếu '{VECTOR_PROJECTION}' {vectors.shape[1]} -> {PROJECTION_DIM} chiều trên {len(vectors)} vector...")
+        projection = fit_projection(vectors, VECTOR_PROJECTION, PROJECTION_DIM, MODEL_KEY, max_samples=PROJECTION_FIT_SAMPLES)
+        if projection is None:
+            print(f"ℹ️ PROJECTION_DIM={PROJECTION_DIM} không nhỏ hơn số chiều gốc ({vectors.shape[1]}), bỏ qua phép chiếu.")
+            remove_projection_file()
+            return True
+        projection.save(PROJECTION_FILE)
+        if projection.method == 'pca':
+            centered = vectors[:PROJECTION_FIT_SAMPLES] - projection.mean
+            kept = np.linalg.norm(centered @ projection.components.T) ** 2 / max(np.linalg.norm(centered) ** 2, 1e-12)
+            print(f"📐 PCA giữ {kept:.1%} phương sai.")
+        print(f"💾 Đã lưu phép chiếu (version {projection.version}) vào '{PROJECTION_FILE}'")
+        return True
+    except Exception as e:
+        print(f"❌ Lỗi khi fit phép chiếu vector: {e}")
+        remove_projection_file()
+        return False
+
+def remove_projection_file():
+    if os.path.exists(PROJECTION_FILE):
+        os.remove(PROJECTION_FILE)
+        print(f"🗑️ Đã xóa phép chiếu cũ '{PROJECTION_FILE}'")
+
+def embed_texts(texts, stats):
+    """
+    Trả về ma trận embedding (N x dim, float32) theo thứ tự `texts`.
+    Text đã có trong cache (cùng model) không chạy lại model; text trùng nhau chỉ embed 1 lần.
+    Trả về None nếu không tải được model hoặc lỗi khi embed.
+    """
+    cache = EmbeddingCache(EMBEDDING_CACHE_DB, MODEL_KEY) if EMBEDDING_CACHE_DB else None
+    try:
+        vectors = cache.get_many(texts) if cache else {}
+        stats["cache_hits"] = sum(1 for text in texts if text in vectors)
+        missing_texts = list(dict.fromkeys(text for text in texts if text not in vectors))
+
+        if missing_texts:
+            print(f"🧠 Cần embed {len(missing_texts)} đoạn text (cache: {stats['cache_hits']}/{len(texts)} sản phẩm).")
+            model = load_model(MODEL_NAME)
+            if model is None:
+                print("❌ Không thể tiếp tục vì không tải được model.")
+                return None
+            try:
+                new_vectors = model.encode(missing_texts, show_progress_bar=True, device='cpu', convert_to_numpy=True)
+                print("✅ Tạo embedding hoàn tất.")
+            except Exception as e:
+                print(f"❌ Lỗi nghiêm trọng khi tạo embedding: {e}")
+                return None
+            if cache: cache.put_many(missing_texts, new_vectors)
+            vectors.update(zip(missing_texts, np.asarray(new_vectors, dtype=np.float32)))
+        else:
+            print(f"✅ Toàn bộ {len(texts)} embedding lấy từ cache, không cần tải model.")
+
+        return np.stack([vectors[text] for text in texts])
+    finally:
+        if cache: cache.close()
+
+def save_columnar(products_to_keep, products_to_embed, embeddings):
+    """ Ghép các dòng giữ nguyên (đọc từ cache, lọc theo id) với các dòng mới, ghi ra Parquet. """
+    import pyarrow as pa
+    tables = []
+    if products_to_keep:
+        tables.append(read_table(EMBED_FILE_PATH, filter_ids=[p['id'] for p in products_to_keep]))
+    if products_to_embed and embeddings is not None:
+        tables.append(products_to_table(products_to_embed, embeddings))
+    table = pa.concat_tables(tables, promote_options='permissive').sort_by('id') if tables else pa.table({})
+    write_table(table, EMBED_FILE_PATH)
+    return table.num_rows
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
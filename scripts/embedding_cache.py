@@ -0,0 +1,50 @@
+"""
+Cache embedding theo nội dung: khóa = (tên model + revision, đúng đoạn text được embed).
+Lưu trong 1 file SQLite (vector float32 dạng bytes), dùng chung giữa các lần chạy và các catalog:
+sản phẩm chỉ đổi giá/ảnh hoặc trùng mô tả sẽ không phải chạy lại model.
+"""
+import hashlib
+import os
+import sqlite3
+import numpy as np
+
+# Giới hạn số tham số trong 1 câu lệnh IN (...) của SQLite
+_LOOKUP_BATCH = 500
+
+class EmbeddingCache:
+    def __init__(self, db_path, model_key):
+        self.db_path = db_path
+        self.model_key = model_key
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, dim INTEGER NOT NULL, vector BLOB NOT NULL) WITHOUT ROWID"
+        )
+
+    def _key(self, text):
+        return hashlib.sha256(f"{self.model_key}\x00{text}".encode('utf-8')).digest()[:16]
+
+    def get_many(self, texts):
+        """ Trả về dict {text: vector float32} cho các text đã có trong cache """
+        keys = {self._key(text): text for text in set(texts)}
+        found = {}
+        key_list = list(keys)
+        for start in range(0, len(key_list), _LOOKUP_BATCH):
+            batch = key_list[start:start + _LOOKUP_BATCH]
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+            )
+            for key, vector in rows: found[keys[key]] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, dim, vector) VALUES (?, ?, ?)",
+                ((self._key(text), vector.shape[0], vector.tobytes()) for text, vector in zip(texts, vectors))
+            )
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,105 @@
+"""
+Xuất toàn bộ document từ Elasticsearch nhanh và gọn bộ nhớ.
+Dùng point-in-time (PIT) + sliced search_after: mỗi slice chạy trên 1 thread với trang lớn.
+- iter_products(): generator, trả từng document (dict) ngay khi có trang mới.
+- export_vectors(): ghi thẳng vector vào ma trận float32 cấp phát trước + mảng ID.
+"""
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+DEFAULT_SLICES = 4
+DEFAULT_PAGE_SIZE = 1000
+KEEP_ALIVE = '2m'
+
+_DONE = object()
+
+def _iter_slice_pages(es, pit_id, slice_id, slices, page_size, source_includes):
+    """ Sinh từng trang hits của 1 slice (search_after theo _shard_doc) """
+    search_after = None
+    while True:
+        kwargs = {"pit": {"id": pit_id, "keep_alive": KEEP_ALIVE}, "size": page_size, "sort": [{"_shard_doc": "asc"}]}
+        if slices > 1: kwargs["slice"] = {"id": slice_id, "max": slices}
+        if search_after is not None: kwargs["search_after"] = search_after
+        if source_includes is not None: kwargs["_source_includes"] = list(source_includes)
+        resp = es.search(**kwargs)
+        pit_id = resp.get('pit_id', pit_id)
+        hits = resp['hits']['hits']
+        if not hits: return
+        yield hits
+        if len(hits) < page_size: return
+        search_after = hits[-1]['sort']
+
+def iter_hit_pages(es, index_name, source_includes=None, slices=DEFAULT_SLICES, page_size=DEFAULT_PAGE_SIZE):
+    """ Sinh các trang hits thô từ mọi slice (thứ tự giữa các slice không xác định) """
+    pit_id = es.open_point_in_time(index=index_name, keep_alive=KEEP_ALIVE)['id']
+    pages = queue.Queue(maxsize=slices * 2) # Giới hạn số trang chờ -> bộ nhớ bị chặn
+    stop = threading.Event()
+
+    def put(item):
+        """ put() có thể dừng khi consumer đã thoát (generator bị đóng giữa chừng) """
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return True
+            except queue.Full: continue
+        return False
+
+    def worker(slice_id):
+        try:
+            for hits in _iter_slice_pages(es, pit_id, slice_id, slices, page_size, source_includes):
+                if not put(hits): return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_DONE)
+
+    pool = ThreadPoolExecutor(max_workers=slices)
+    try:
+        for slice_id in range(slices): pool.submit(worker, slice_id)
+        finished = 0
+        while finished < slices:
+            item = pages.get()
+            if item is _DONE: finished += 1
+            elif isinstance(item, Exception): raise item
+            else: yield item
+    finally:
+        stop.set()
+        pool.shutdown(wait=True)
+        try: es.close_point_in_time(id=pit_id)
+        except Exception: pass
+
+def iter_products(es, index_name, source_includes=None, slices=DEFAULT_SLICES, page_size=DEFAULT_PAGE_SIZE):
+    """ Sinh từng document dạng {"_id": ..., **_source} """
+    for hits in iter_hit_pages(es, index_name, source_includes, slices, page_size):
+        for hit in hits: yield {"_id": hit['_id'], **hit.get('_source', {})}
+
+def export_vectors(es, index_name, vector_field='product_embedding', fields=(), slices=DEFAULT_SLICES, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Tải toàn bộ vector vào ma trận float32 (N x dim) cấp phát trước.
+    Trả về (ids: mảng object, vectors: ndarray float32, extra: {field: mảng object}).
+    Document thiếu vector bị bỏ qua.
+    """
+    capacity = max(es.count(index=index_name)['count'], 1)
+    ids = np.empty(capacity, dtype=object)
+    extra = {field: np.empty(capacity, dtype=object) for field in fields}
+    vectors = None
+    row = 0
+    for hits in iter_hit_pages(es, index_name, [vector_field, *fields], slices, page_size):
+        for hit in hits:
+            source = hit.get('_source', {})
+            vector = source.get(vector_field)
+            if not vector: continue
+            if vectors is None: vectors = np.empty((capacity, len(vector)), dtype=np.float32)
+            if row >= capacity: # Index có thêm document sau khi đếm -> nới gấp đôi
+                ids = np.concatenate([ids, np.empty(capacity, dtype=object)])
+                vectors = np.concatenate([vectors, np.empty_like(vectors)])
+                for field in fields: extra[field] = np.concatenate([extra[field], np.empty(capacity, dtype=object)])
+                capacity *= 2
+            vectors[row] = vector
+            ids[row] = hit['_id']
+            for field in fields: extra[field][row] = source.get(field)
+            row += 1
+    if vectors is None: vectors = np.empty((0, 0), dtype=np.float32)
+    return ids[:row], vectors[:row], {field: values[:row] for field, values in extra.items()}
@@ -1,10 +1,15 @@
+import argparse
 import os
 import sys
 import json
-from elasticsearch import Elasticsearch, NotFoundError
+import time
+from elasticsearch import Elasticsearch
 from dotenv import load_dotenv
 from tqdm import tqdm
 import numpy as np
+from es_export import export_vectors
+from columnar_io import read_embeddings
+from projection import fit_projection
 
 try:
     import ml_metrics
@@ -16,6 +21,11 @@ load_dotenv()
 ES_HOST = os.getenv("ELASTICSEARCH_HOST", "http://localhost:9200")
 INDEX_NAME = os.getenv("INDEX_NAME", "products")
 TOP_K = 5
+EXPORT_SLICES = int(os.getenv("EXPORT_SLICES", 4))
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", 1000))
+EMBED_FILE_PATH = os.getenv("EMBEDDED_JSON_FILE", "data/mock_products_with_embedding.json")
+# Ngân sách RAM cho vector HNSW để ước tính số sản phẩm tối đa/node (chế độ --dims)
+VECTOR_RAM_BUDGET_MB = float(os.getenv("VECTOR_RAM_BUDGET_MB", 256))
 
 def connect_es():
     try:
@@ -27,32 +37,18 @@ def connect_es():
         print(f"❌ Lỗi kết nối Elasticsearch: {e}")
         sys.exit(1)
 
-def get_all_products_with_embedding(es, index_name):
-    print(f"⏳ Đang tải tất cả sản phẩm và embedding từ index '{index_name}'...")
-    all_hits = []
+def load_vectors(es, index_name):
+    """ Tải (ids, ma trận vector float32, mảng category) bằng export_vectors: không tạo list dict kèm vector """
+    print(f"⏳ Đang tải embedding từ index '{index_name}' ({EXPORT_SLICES} slice, {EXPORT_PAGE_SIZE}/trang)...")
     try:
-        resp = es.search(
-            index=index_name, query={"match_all": {}}, scroll='2m', size=100,
-            _source_includes=["id", "name", "category", "product_embedding"]
+        ids, vectors, extra = export_vectors(
+            es, index_name, fields=("category",), slices=EXPORT_SLICES, page_size=EXPORT_PAGE_SIZE
         )
-        scroll_id = resp['_scroll_id']
-        all_hits.extend(resp['hits']['hits'])
-
-        while len(resp['hits']['hits']):
-            resp = es.scroll(scroll_id=scroll_id, scroll='2m')
-            scroll_id = resp['_scroll_id']
-            all_hits.extend(resp['hits']['hits'])
-
-        print(f"✅ Đã tải {len(all_hits)} sản phẩm.")
-        try: es.clear_scroll(scroll_id=scroll_id)
-        except NotFoundError: pass
-
-        # Trả về list {_id: ..., id: ..., name: ..., ...}
-        products = [{"_id": hit['_id'], **hit['_source']} for hit in all_hits]
-        return products
+        print(f"✅ Đã tải {len(ids)} vector ({vectors.nbytes / 1024 ** 2:.1f}MB).")
+        return ids, vectors, extra["category"]
     except Exception as e:
         print(f"❌ Lỗi khi tải sản phẩm từ Elasticsearch: {e}")
-        return []
+        return None, None, None
 
 def find_similar_for_eval(es, index_name, query_vector, exclude_doc_id, k):
     """ Tìm k sản phẩm tương tự, trả về list {_id, category, score} """
@@ -96,12 +92,80 @@ def calculate_metrics(query_product, recommendations, k):
         "relevant_list": relevant_doc_ids_in_order
     }
 
+# === SO SÁNH THEO SỐ CHIỀU (offline, từ file embedding đầy đủ chiều, không cần ES) ===
+def hnsw_ram_bytes(num_vectors, dim):
+    """ Ước tính RAM cho dense_vector float + HNSW theo tài liệu ES: num_vectors * 4 * (dim + 12) """
+    return num_vectors * 4 * (dim + 12)
+
+def top_k_neighbors(vectors, query_indices, k, batch_size=256):
+    """ Top-k láng giềng (cosine, vector đã chuẩn hóa) cho từng query, bỏ chính nó. Trả về (ma trận chỉ số, giây/truy vấn) """
+    results = []
+    start = time.perf_counter()
+    for offset in range(0, len(query_indices), batch_size):
+        batch = query_indices[offset:offset + batch_size]
+        scores = vectors[batch] @ vectors.T
+        scores[np.arange(len(batch)), batch] = -np.inf
+        top = np.argpartition(-scores, k, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        results.append(np.take_along_axis(top, order, axis=1))
+    return np.vstack(results), (time.perf_counter() - start) / max(len(query_indices), 1)
+
+def evaluate_dimensions(dims, method, num_queries, k=TOP_K, seed=0):
+    """
+    Với mỗi số chiều: chiếu toàn bộ catalog (PCA fit trên catalog hoặc truncate), tìm top-k bằng brute-force và so với
+    top-k ở số chiều gốc. Báo cáo recall@k (giữ được bao nhiêu láng giềng gốc), P@k theo category,
+    thời gian tìm/truy vấn (brute-force, chỉ để so sánh tương đối) và RAM vector ước tính trên ES.
+    """
+    print(f"⏳ Đọc embedding đầy đủ chiều từ '{EMBED_FILE_PATH}'...")
+    try: vectors, columns = read_embeddings(EMBED_FILE_PATH, columns=('category',))
+    except Exception as e:
+        print(f"❌ Lỗi đọc file embedding: {e}")
+        return
+    if len(vectors) <= k:
+        print("❌ Không đủ sản phẩm để đánh giá.")
+        return
+    categories = np.asarray(columns['category'], dtype=object)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    source_dim = vectors.shape[1]
+    rng = np.random.default_rng(seed)
+    query_indices = np.sort(rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False))
+    baseline, _ = top_k_neighbors(vectors, query_indices, k)
+
+    print(f"\n⚙️ So sánh {method} trên {len(vectors)} sản phẩm, {len(query_indices)} truy vấn (Top-{k})...")
+    print(f"  {'Số chiều':>8}  {'Recall@' + str(k):>9}  {'P@' + str(k):>7}  {'ms/truy vấn':>11}  {'RAM vector':>11}  {'SP tối đa/' + str(int(VECTOR_RAM_BUDGET_MB)) + 'MB':>16}")
+    for dim in sorted({min(d, source_dim) for d in dims}, reverse=True):
+        try: projection = fit_projection(vectors, method, dim)
+        except ValueError as e:
+            print(f"  {dim:>8}  ⚠️ Bỏ qua: {e}")
+            continue
+        projected = vectors if projection is None else projection.apply(vectors)
+        neighbors, seconds_per_query = top_k_neighbors(projected, query_indices, k)
+        recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbors, baseline)])
+        precision = np.mean(categories[neighbors] == categories[query_indices][:, None])
+        ram_mb = hnsw_ram_bytes(len(vectors), dim) / 1024 ** 2
+        capacity = int(VECTOR_RAM_BUDGET_MB * 1024 ** 2 // hnsw_ram_bytes(1, dim))
+        print(f"  {dim:>8}  {recall:>9.4f}  {precision:>7.4f}  {seconds_per_query * 1000:>11.3f}  {ram_mb:>9.1f}MB  {capacity:>16,}")
+    print("ℹ️ Recall: tỉ lệ láng giềng trùng với số chiều gốc. Bật cho index: VECTOR_PROJECTION + PROJECTION_DIM rồi chạy lại embed + import.")
+
+def setup_argparse():
+    parser = argparse.ArgumentParser(description="Đánh giá chất lượng gợi ý (kNN trên ES) hoặc so sánh theo số chiều vector.")
+    parser.add_argument("--dims", help="Danh sách số chiều, vd '384,256,128,64': so sánh offline thay vì đánh giá index.")
+    parser.add_argument("--method", choices=["pca", "truncate"], default=os.getenv("VECTOR_PROJECTION", "pca").replace("none", "pca"),
+                        help="Phép giảm chiều khi so sánh --dims.")
+    parser.add_argument("--queries", type=int, default=1000, help="Số sản phẩm dùng làm truy vấn khi so sánh --dims.")
+    return parser.parse_args()
+
 def main():
+    args = setup_argparse()
+    if args.dims:
+        evaluate_dimensions([int(d) for d in args.dims.split(",")], args.method, args.queries)
+        return
+
     print("\n--- Bắt đầu quy trình đánh giá hệ thống gợi ý ---")
     es = connect_es()
-    all_products = get_all_products_with_embedding(es, INDEX_NAME)
+    ids, vectors, categories = load_vectors(es, INDEX_NAME)
 
-    if not all_products:
+    if ids is None or len(ids) == 0:
         print("❌ Không có sản phẩm nào để đánh giá.")
         return
 
@@ -111,25 +175,30 @@ def main():
     all_predicted_relevant_ids = []
     evaluated_count = 0
 
-    print(f"\n⚙️ Đánh giá Top-{TOP_K} gợi ý cho {len(all_products)} sản phẩm...")
-    for product in tqdm(all_products, desc="📊 Đang đánh giá"):
-        product_doc_id = product.get('_id') # ID của ES
-        query_vector = product.get('product_embedding')
-        query_category = product.get('category')
+    # Ground truth theo category: gom chỉ số 1 lần thay vì quét toàn catalog cho mỗi sản phẩm
+    ids_by_category = {}
+    if ml_metrics:
+        for category in set(categories.tolist()) - {None}:
+            ids_by_category[category] = ids[categories == category].tolist()
+
+    print(f"\n⚙️ Đánh giá Top-{TOP_K} gợi ý cho {len(ids)} sản phẩm...")
+    for row in tqdm(range(len(ids)), desc="📊 Đang đánh giá"):
+        product_doc_id = ids[row] # ID của ES
+        query_category = categories[row]
 
-        if not product_doc_id or not query_vector or not query_category:
+        if not product_doc_id or not query_category:
             continue
         evaluated_count += 1
 
-        recommendations = find_similar_for_eval(es, INDEX_NAME, query_vector, product_doc_id, TOP_K)
-        metrics = calculate_metrics(product, recommendations, TOP_K)
+        recommendations = find_similar_for_eval(es, INDEX_NAME, vectors[row].tolist(), product_doc_id, TOP_K)
+        metrics = calculate_metrics({"category": query_category}, recommendations, TOP_K)
 
         total_avg_cosine += metrics['avg_cosine']
         total_precision_at_k += metrics['precision_at_k']
 
         if ml_metrics:
             # Ground truth là list các _id khác cùng category
-            actual_relevant = [p['_id'] for p in all_products if p.get('category') == query_category and p.get('_id') != product_doc_id]
+            actual_relevant = [doc_id for doc_id in ids_by_category[query_category] if doc_id != product_doc_id]
             all_actual_relevant_ids.append(actual_relevant)
             all_predicted_relevant_ids.append(metrics['relevant_list'])
 
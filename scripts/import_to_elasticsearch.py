@@ -1,8 +1,12 @@
+import base64
 import json
 import sys
 import os
+import numpy as np
 from elasticsearch import Elasticsearch, helpers
 from dotenv import load_dotenv
+from columnar_io import EMBEDDING_COLUMN, count_products, is_parquet, iter_product_batches, read_products
+from projection import Projection
 
 load_dotenv()
 
@@ -15,23 +19,94 @@ except ValueError:
     print("❌ Lỗi: VECTOR_DIM trong .env phải là số nguyên.")
     sys.exit(1)
 
-def get_es_mapping():
+# Phép chiếu giảm chiều do embed_to_json.py fit (VECTOR_PROJECTION=pca|truncate). Khi bật, VECTOR_DIM lấy theo phép chiếu.
+VECTOR_PROJECTION = os.getenv("VECTOR_PROJECTION", "none")
+PROJECTION_FILE = os.getenv("PROJECTION_FILE", "data/projection.npz")
+# Index phụ lưu phép chiếu (theo version) để backend chiếu vector truy vấn giống hệt lúc import
+PROJECTION_INDEX = os.getenv("PROJECTION_INDEX", f"{INDEX_NAME}_projection")
+
+# 'folded': thêm subfield .folded bỏ dấu (asciifolding) cho name/description -> "dien thoai" khớp "điện thoại"
+# 'standard': mapping cũ, chỉ analyzer standard
+KEYWORD_ANALYSIS = os.getenv("KEYWORD_ANALYSIS", "folded")
+
+def get_es_settings():
+    if KEYWORD_ANALYSIS != "folded": return None
+    return {
+        "analysis": {
+            "analyzer": {
+                "vi_folded": {
+                    "type": "custom", "tokenizer": "standard",
+                    # asciifolding: bỏ dấu tiếng Việt (ế -> e, đ -> d)
+                    "filter": ["lowercase", "asciifolding"]
+                }
+            }
+        }
+    }
+
+def text_field():
+    field = {"type": "text", "analyzer": "standard"}
+    if KEYWORD_ANALYSIS == "folded": field["fields"] = {"folded": {"type": "text", "analyzer": "vi_folded"}}
+    return field
+
+def get_es_mapping(projection=None):
     return {
+        # Version phép chiếu gắn với index: backend đọc _meta để lấy đúng phép chiếu
+        "_meta": {"projection": projection.metadata() if projection else None},
         "properties": {
             "id": {"type": "keyword"}, # ID gốc từ CSV
-            "name": {"type": "text", "analyzer": "standard"},
-            "description": {"type": "text", "analyzer": "standard"},
+            "name": text_field(),
+            "description": text_field(),
             "category": {"type": "keyword"},
             "price": {"type": "float"},
             "image_url": {"type": "keyword", "index": False},
             "data_hash": {"type": "keyword", "index": False},
             "product_embedding": {
-                "type": "dense_vector", "dims": VECTOR_DIM,
+                "type": "dense_vector", "dims": projection.dim if projection else VECTOR_DIM,
                 "index": "true", "similarity": "cosine"
             }
         }
     }
 
+def load_projection():
+    """ Phép chiếu đã fit (hoặc None nếu VECTOR_PROJECTION='none') """
+    if VECTOR_PROJECTION == "none": return None
+    if not os.path.exists(PROJECTION_FILE):
+        print(f"❌ Lỗi: VECTOR_PROJECTION='{VECTOR_PROJECTION}' nhưng không tìm thấy '{PROJECTION_FILE}'.")
+        print("ℹ️ Chạy lại 'embed_to_json.py' với cùng cấu hình để fit phép chiếu.")
+        sys.exit(1)
+    projection = Projection.load(PROJECTION_FILE)
+    print(f"📐 Dùng phép chiếu {projection.method} {projection.source_dim} -> {projection.dim} chiều (version {projection.version})")
+    return projection
+
+def check_projection(projection, sample_products):
+    """ Phép chiếu phải khớp số chiều vector trong file (vd: fit với model cũ rồi đổi model) """
+    if projection is None: return
+    vector = next((p.get(EMBEDDING_COLUMN) for p in sample_products if p.get(EMBEDDING_COLUMN)), None)
+    if vector is not None and len(vector) != projection.source_dim:
+        print(f"❌ Lỗi: Phép chiếu '{PROJECTION_FILE}' cần vector {projection.source_dim} chiều nhưng dữ liệu có {len(vector)} chiều.")
+        print("ℹ️ Chạy lại 'embed_to_json.py' để fit lại phép chiếu.")
+        sys.exit(1)
+
+def store_projection(es, projection):
+    """ Lưu ma trận chiếu vào PROJECTION_INDEX (_id = version), dữ liệu dạng base64 float32, không index """
+    if not es.indices.exists(index=PROJECTION_INDEX):
+        es.indices.create(index=PROJECTION_INDEX, mappings={"dynamic": False, "properties": {"version": {"type": "keyword"}}})
+    document = {
+        **projection.metadata(),
+        "mean": base64.b64encode(projection.mean.tobytes()).decode("ascii"),
+        "components": base64.b64encode(projection.components.tobytes()).decode("ascii"),
+    }
+    es.index(index=PROJECTION_INDEX, id=projection.version, document=document, refresh=True)
+    print(f"💾 Đã lưu phép chiếu vào index '{PROJECTION_INDEX}' (id={projection.version})")
+
+def project_batch(products, projection):
+    """ Chiếu embedding của cả lô bằng 1 phép nhân ma trận """
+    with_vectors = [p for p in products if p.get(EMBEDDING_COLUMN)]
+    if not with_vectors: return products
+    projected = projection.apply(np.asarray([p[EMBEDDING_COLUMN] for p in with_vectors], dtype=np.float32))
+    for product, vector in zip(with_vectors, projected): product[EMBEDDING_COLUMN] = vector.tolist()
+    return products
+
 def connect_es():
     try:
         es = Elasticsearch(hosts=[ES_HOST], verify_certs=False, ssl_show_warn=False)
@@ -48,12 +123,11 @@ def load_json_data(file_path, encoding='utf-8-sig'):
         print("ℹ️ Chạy script 'embed_to_json.py' trước?")
         sys.exit(1)
     try:
-        with open(file_path, 'r', encoding=encoding) as f:
-            data = json.load(f)
-            if not isinstance(data, list):
-                print(f"❌ Lỗi: File JSON '{file_path}' không phải list.")
-                sys.exit(1)
-            return data
+        data = read_products(file_path, encoding=encoding) # .json (mảng) hoặc .jsonl
+        if not isinstance(data, list):
+            print(f"❌ Lỗi: File JSON '{file_path}' không phải list.")
+            sys.exit(1)
+        return data
     except json.JSONDecodeError:
         print(f"❌ Lỗi: File {file_path} lỗi JSON.")
         sys.exit(1)
@@ -61,38 +135,66 @@ def load_json_data(file_path, encoding='utf-8-sig'):
         print(f"❌ Lỗi đọc file {file_path}: {e}")
         sys.exit(1)
 
-def generate_bulk_actions(products, index_name):
-    """ Dùng ID gốc ('id') làm _id của Elasticsearch """
+# Các cột chỉ dùng nội bộ pipeline, không cần nạp vào ES
+SKIP_COLUMNS = ('data_hash',)
+
+def generate_bulk_actions_from_file(file_path, index_name, projection=None):
+    """ Đọc file .parquet theo lô (bỏ các cột trong SKIP_COLUMNS) và sinh bulk action, không nạp toàn bộ file vào bộ nhớ """
+    for batch in iter_product_batches(file_path, exclude_columns=SKIP_COLUMNS):
+        yield from generate_bulk_actions(batch, index_name, projection)
+
+def generate_bulk_actions(products, index_name, projection=None, batch_size=1000):
+    """ Dùng ID gốc ('id') làm _id của Elasticsearch. Có projection -> chiếu embedding theo từng lô. """
+    if projection is not None and len(products) > batch_size:
+        for start in range(0, len(products), batch_size):
+            yield from generate_bulk_actions(products[start:start + batch_size], index_name, projection, batch_size)
+        return
+    if projection is not None: products = project_batch(products, projection)
     for product in products:
         doc_id = product.get('id')
         if not doc_id:
              print(f"⚠️ Cảnh báo: Bỏ qua sản phẩm thiếu 'id': {product.get('name')}")
              continue
-        yield { "_index": index_name, "_id": doc_id, "_source": product }
+        source = {key: value for key, value in product.items() if key not in SKIP_COLUMNS}
+        yield { "_index": index_name, "_id": doc_id, "_source": source }
 
 def main():
     print(f"\n--- Bắt đầu quy trình nạp dữ liệu vào Elasticsearch ---")
     es = connect_es()
-    mapping = get_es_mapping()
+    projection = load_projection()
+    mapping = get_es_mapping(projection)
+
+    # Đọc nguồn dữ liệu (và kiểm tra phép chiếu) trước khi xóa index cũ
+    if is_parquet(INPUT_JSON):
+        if not os.path.exists(INPUT_JSON):
+            print(f"❌ Lỗi: Không tìm thấy file dữ liệu '{INPUT_JSON}'.")
+            sys.exit(1)
+        total_products = count_products(INPUT_JSON)
+        first_batch = next(iter_product_batches(INPUT_JSON, batch_size=1), [])
+        actions = generate_bulk_actions_from_file(INPUT_JSON, INDEX_NAME, projection)
+    else:
+        products = load_json_data(INPUT_JSON)
+        total_products = len(products)
+        first_batch = products[:1]
+        actions = generate_bulk_actions(products, INDEX_NAME, projection)
+    if not total_products:
+        print("⚠️ Không có sản phẩm nào để nạp.")
+        return
+    check_projection(projection, first_batch)
 
     try:
         if es.indices.exists(index=INDEX_NAME):
             print(f"⏳ Index '{INDEX_NAME}' đã tồn tại. Đang xóa...")
             es.indices.delete(index=INDEX_NAME, ignore=[400, 404])
         print(f"⏳ Đang tạo index '{INDEX_NAME}' mới...")
-        es.indices.create(index=INDEX_NAME, mappings=mapping)
-        print("✅ Tạo index thành công.")
+        if projection is not None: store_projection(es, projection)
+        es.indices.create(index=INDEX_NAME, mappings=mapping, settings=get_es_settings())
+        print(f"✅ Tạo index thành công ({mapping['properties']['product_embedding']['dims']} chiều).")
     except Exception as e:
         print(f"❌ Lỗi khi thiết lập index '{INDEX_NAME}': {e}")
         sys.exit(1)
 
-    products = load_json_data(INPUT_JSON)
-    if not products:
-        print("⚠️ Không có sản phẩm nào để nạp.")
-        return
-
-    print(f"⏳ Chuẩn bị nạp {len(products)} sản phẩm vào '{INDEX_NAME}'...")
-    actions = generate_bulk_actions(products, INDEX_NAME)
+    print(f"⏳ Chuẩn bị nạp {total_products} sản phẩm vào '{INDEX_NAME}'...")
     success_count = 0
     fail_count = 0
 
@@ -108,7 +210,7 @@ def main():
                  error_details = fail_info.get('index', {}).get('error', {})
                  doc_id = fail_info.get('index', {}).get('_id', 'N/A')
                  print(f"  - ID: {doc_id}, Lỗi: {error_details.get('reason', error_details)}")
-        if success_count < len(products):
+        if success_count < total_products:
              print(f"⚠️ Lưu ý: Số lượng nạp thành công ít hơn số sản phẩm trong file.")
 
     except Exception as e:
@@ -1,9 +1,10 @@
 import pandas as pd
-import json
+import csv
 import os
 import sys
 from dotenv import load_dotenv
 import numpy as np
+from columnar_io import write_products
 
 load_dotenv()
 
@@ -11,6 +12,203 @@ load_dotenv()
 INPUT_FILE_PATH = os.getenv('RAW_CSV_FILE', 'data/raw_products.csv')
 OUTPUT_CSV_UTF8 = os.getenv('PREPROCESSED_CSV_FILE', 'data/raw_products_utf8.csv')
 OUTPUT_JSON = os.getenv('PREPROCESSED_JSON_FILE', 'data/mock_products.json')
+# Chế độ chunk: 0 = đọc toàn bộ file (cũ). >0 = đọc/xử lý/ghi từng khối N dòng, bộ nhớ bị chặn.
+PREPROCESS_CHUNKSIZE = int(os.getenv('PREPROCESS_CHUNKSIZE', 0))
+# Ở chế độ chunk, bản sao CSV UTF-8 chỉ được ghi khi bật cờ này
+WRITE_UTF8_CSV = os.getenv('PREPROCESS_WRITE_CSV', '0').lower() in ('1', 'true', 'yes')
+REQUIRED_COLS = ['id', 'name', 'description', 'price', 'image_url', 'category']
+
+def clean_products(df):
+    """ Chuẩn hóa các cột bắt buộc (vectorized). Không xử lý trùng lặp ID. """
+    # Chuyển đổi ID sang chuỗi, loại bỏ .0 nếu có (thường gặp khi đọc từ Excel)
+    df['id'] = df['id'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
+    df.dropna(subset=['id'], inplace=True)
+    df['name'] = df['name'].fillna('Không có tên').astype(str).str.strip()
+    df['description'] = df['description'].fillna('').astype(str).str.strip()
+    df['category'] = df['category'].fillna('Chưa phân loại').astype(str).str.strip()
+    df['image_url'] = df['image_url'].fillna('').astype(str).str.strip()
+    # Luôn float64: nếu để pandas tự suy kiểu, khối chỉ có giá nguyên thành int64 và lệch schema với khối sau (.parquet)
+    df['price'] = pd.to_numeric(df['price'], errors='coerce').astype('float64')
+    return df
+
+# === CÁC HÀM CHO CHẾ ĐỘ CHUNK ===
+# Ở chế độ chunk mọi cột được đọc dạng chuỗi (price chuyển số trong clean_products): kiểu suy ra từ khối đầu
+# (vd: cột 'stock' toàn số) có thể sai ở khối sau ('hết hàng') và làm hỏng cả lần chạy.
+def read_csv_header(file_path):
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as f: return next(csv.reader(f), [])
+
+def stringify_columns(df):
+    """ Đưa mọi cột (trừ price) về chuỗi, giữ None; dùng cho nguồn không đọc được dạng chuỗi (Excel) """
+    for col in df.columns:
+        if col != 'price': df[col] = df[col].map(str, na_action='ignore').astype(object)
+    return df
+
+def iter_csv_chunks(file_path, chunksize):
+    """ Đọc CSV theo khối đúng `chunksize` dòng. Dùng pyarrow (streaming, đa luồng) nếu có, ngược lại dùng pandas chunksize. """
+    try:
+        import pyarrow as pa
+        from pyarrow import csv as pa_csv
+    except ImportError:
+        pa = None
+    if pa is not None:
+        print("ℹ️  Đọc CSV bằng pyarrow (streaming).")
+        reader = pa_csv.open_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(block_size=max(1 << 20, chunksize * 512)),
+            convert_options=pa_csv.ConvertOptions(column_types={col: pa.string() for col in read_csv_header(file_path)}, strings_can_be_null=True)
+        )
+        # Block của pyarrow tính theo byte -> cắt/gộp lại thành khối `chunksize` dòng
+        pending, pending_rows = [], 0
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            while pending_rows >= chunksize:
+                table = pa.Table.from_batches(pending)
+                yield table.slice(0, chunksize).to_pandas()
+                rest = table.slice(chunksize)
+                pending, pending_rows = rest.to_batches(), rest.num_rows
+        if pending_rows: yield pa.Table.from_batches(pending).to_pandas()
+        return
+    print("ℹ️  Đọc CSV bằng pandas (chunksize).")
+    # utf-8-sig đọc được cả file UTF-8 có và không có BOM
+    yield from pd.read_csv(file_path, encoding='utf-8-sig', chunksize=chunksize, dtype=str)
+
+def iter_excel_chunks(file_path, chunksize):
+    """ Đọc Excel theo khối. .xlsx dùng openpyxl read_only (streaming); .xls phải đọc toàn bộ rồi cắt. """
+    if file_path.lower().endswith('.xls'):
+        df = pd.read_excel(file_path, dtype=str)
+        for start in range(0, len(df), chunksize): yield df.iloc[start:start + chunksize].copy()
+        return
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = [str(col) if col is not None else '' for col in next(rows, [])]
+        buffer = []
+        for row in rows:
+            buffer.append(row)
+            if len(buffer) >= chunksize:
+                yield stringify_columns(pd.DataFrame(buffer, columns=header))
+                buffer = []
+        if buffer: yield stringify_columns(pd.DataFrame(buffer, columns=header))
+    finally:
+        workbook.close()
+
+class ChunkWriter:
+    """
+    Ghi kết quả từng khối, định dạng theo đuôi file:
+    - .json: mảng JSON (tương thích embed_to_json.py), ghi nối tiếp, không thụt lề
+    - .jsonl / .ndjson: mỗi dòng 1 sản phẩm
+    - .parquet: cần pyarrow, schema cố định theo cột của khối đầu tiên (price: float64, còn lại: string)
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.format = os.path.splitext(file_path)[1].lower()
+        self.count = 0
+        self._file = None
+        self._parquet_writer = None
+        self._schema = None
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        if self.format in ('.json', '.jsonl', '.ndjson'):
+            self._file = open(file_path, 'w', encoding='utf-8')
+            if self.format == '.json': self._file.write('[')
+        elif self.format != '.parquet':
+            raise ValueError(f"Định dạng đầu ra '{self.format}' không được hỗ trợ (.json, .jsonl, .parquet).")
+
+    def write(self, df):
+        if df.empty: return
+        if self.format == '.parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._schema is None: # Không suy kiểu: cột toàn null ở khối đầu sẽ thành kiểu null
+                self._schema = pa.schema([(col, pa.float64() if col == 'price' else pa.string()) for col in df.columns])
+            table = pa.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.file_path, self._schema)
+            self._parquet_writer.write_table(table)
+        elif self.format == '.json':
+            records = df.to_json(orient='records', force_ascii=False)[1:-1] # Bỏ '[' và ']'
+            self._file.write((',\n' if self.count else '\n') + records)
+        else:
+            self._file.write(df.to_json(orient='records', lines=True, force_ascii=False).rstrip('\n') + '\n')
+        self.count += len(df)
+
+    def close(self):
+        if self._file is not None and not self._file.closed:
+            if self.format == '.json': self._file.write('\n]\n')
+            self._file.close()
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def discard(self):
+        """ Đóng và xóa file đầu ra dở dang (khi xử lý lỗi giữa chừng) """
+        self.close()
+        if os.path.exists(self.file_path): os.remove(self.file_path)
+
+try:
+    from pyarrow import ArrowException
+    ARROW_ERRORS = (ArrowException,)
+except ImportError:
+    ARROW_ERRORS = ()
+
+def preprocess_chunked(chunksize):
+    """ Đọc -> làm sạch -> loại trùng -> ghi theo từng khối, không giữ toàn bộ catalog trong bộ nhớ. """
+    print(f"ℹ️  Chế độ chunk: {chunksize} dòng/khối.")
+    file_extension = os.path.splitext(INPUT_FILE_PATH)[1].lower()
+    if file_extension == '.csv': chunks = iter_csv_chunks(INPUT_FILE_PATH, chunksize)
+    elif file_extension in ['.xlsx', '.xls']: chunks = iter_excel_chunks(INPUT_FILE_PATH, chunksize)
+    else:
+        print(f"❌ Lỗi: Định dạng file '{file_extension}' không được hỗ trợ.")
+        sys.exit(1)
+
+    # Tập ID đã thấy: mảng uint64 (hash 64-bit của ID) đã sắp xếp, ~8 byte/ID thay vì 1 object str
+    seen_hashes = np.empty(0, dtype=np.uint64)
+    duplicated_count, duplicated_examples = 0, []
+    try: writer = ChunkWriter(OUTPUT_JSON)
+    except ValueError as e:
+        print(f"❌ Lỗi: {e}")
+        sys.exit(1)
+    csv_written = False
+    try:
+        for chunk_index, df in enumerate(chunks):
+            missing_cols = [col for col in REQUIRED_COLS if col not in df.columns]
+            if missing_cols:
+                print(f"❌ Lỗi: File đầu vào thiếu các cột bắt buộc: {', '.join(missing_cols)}")
+                sys.exit(1)
+            if WRITE_UTF8_CSV:
+                df.to_csv(OUTPUT_CSV_UTF8, index=False, encoding='utf-8-sig' if not csv_written else 'utf-8',
+                          mode='a' if csv_written else 'w', header=not csv_written)
+                csv_written = True
+
+            df = clean_products(df)
+            hashes = pd.util.hash_pandas_object(df['id'], index=False).to_numpy(dtype=np.uint64)
+            is_duplicated = pd.Series(hashes).duplicated(keep='first').to_numpy() | np.isin(hashes, seen_hashes, assume_unique=False)
+            if is_duplicated.any():
+                duplicated_count += int(is_duplicated.sum())
+                duplicated_examples.extend(df['id'].to_numpy()[is_duplicated][:max(0, 5 - len(duplicated_examples))])
+                df = df[~is_duplicated]
+                hashes = hashes[~is_duplicated]
+            seen_hashes = np.union1d(seen_hashes, hashes)
+
+            writer.write(df)
+            print(f"   ✅ Khối {chunk_index + 1}: {writer.count} sản phẩm hợp lệ (tổng).")
+    except UnicodeDecodeError:
+        print(f"❌ Lỗi: File '{INPUT_FILE_PATH}' không phải UTF-8/UTF-8-SIG.")
+        writer.discard()
+        sys.exit(1)
+    except (ValueError, TypeError, OSError, *ARROW_ERRORS) as e: # ArrowTypeError không kế thừa ValueError
+        print(f"❌ Lỗi khi xử lý theo khối: {e}")
+        writer.discard()
+        sys.exit(1)
+    finally:
+        writer.close()
+
+    if duplicated_count:
+        print(f"⚠️ Cảnh báo: Đã bỏ {duplicated_count} dòng trùng ID (giữ dòng đầu tiên). Ví dụ: {', '.join(map(str, duplicated_examples))}")
+    if csv_written: print(f"💾 Đã tạo bản sao CSV chuẩn UTF-8-SIG tại: {OUTPUT_CSV_UTF8}")
+    print(f"✅ Tiền xử lý thành công! Đã lưu {writer.count} sản phẩm vào {OUTPUT_JSON}")
+    print("--- Kết thúc quy trình tiền xử lý ---")
 
 def main():
     print(f"\n--- Bắt đầu quy trình tiền xử lý ---")
@@ -21,6 +219,10 @@ def main():
         print(f"ℹ️  Hãy chắc chắn biến RAW_CSV_FILE trong file .env trỏ đúng file (có thể là .csv hoặc .xlsx)")
         sys.exit(1)
 
+    if PREPROCESS_CHUNKSIZE > 0:
+        preprocess_chunked(PREPROCESS_CHUNKSIZE)
+        return
+
     df = None
     file_extension = os.path.splitext(INPUT_FILE_PATH)[1].lower()
 
@@ -75,16 +277,13 @@ def main():
 
     
     # === PHẦN KIỂM TRA VÀ XỬ LÝ (GIỮ NGUYÊN) ===
-    required_cols = ['id', 'name', 'description', 'price', 'image_url', 'category']
-    missing_cols = [col for col in required_cols if col not in df.columns]
+    missing_cols = [col for col in REQUIRED_COLS if col not in df.columns]
     if missing_cols:
         print(f"❌ Lỗi: File đầu vào thiếu các cột bắt buộc: {', '.join(missing_cols)}")
         sys.exit(1)
 
     # Đảm bảo ID là duy nhất và là chuỗi
-    # Chuyển đổi ID sang chuỗi, loại bỏ .0 nếu có (thường gặp khi đọc từ Excel)
-    df['id'] = df['id'].astype(str).str.replace(r'\.0$', '', regex=True).str.strip()
-    df.dropna(subset=['id'], inplace=True)
+    df = clean_products(df)
     duplicated_ids = df[df.duplicated('id', keep=False)]['id'].unique()
     if len(duplicated_ids) > 0:
         print(f"⚠️ Cảnh báo: Tìm thấy ID sản phẩm trùng lặp:")
@@ -92,27 +291,19 @@ def main():
         print("ℹ️  Xóa các dòng trùng lặp ID, chỉ giữ lại dòng đầu tiên.")
         df.drop_duplicates(subset=['id'], keep='first', inplace=True)
 
-    df['name'] = df['name'].fillna('Không có tên').astype(str).str.strip()
-    df['description'] = df['description'].fillna('').astype(str).str.strip()
-    df['category'] = df['category'].fillna('Chưa phân loại').astype(str).str.strip()
-    df['image_url'] = df['image_url'].fillna('').astype(str).str.strip()
-    df['price'] = pd.to_numeric(df['price'], errors='coerce')
-
     # Chuyển NaN (xuất hiện sau pd.to_numeric) thành None (null trong JSON)
     df = df.replace({np.nan: None})
 
     products = df.to_dict('records')
 
     try:
-        os.makedirs(os.path.dirname(OUTPUT_JSON), exist_ok=True)
-        with open(OUTPUT_JSON, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=4)
+        write_products(products, OUTPUT_JSON) # Định dạng theo đuôi file: .json / .jsonl / .parquet
 
         print(f"✅ Tiền xử lý thành công! Đã lưu {len(products)} sản phẩm vào {OUTPUT_JSON}")
         print("--- Kết thúc quy trình tiền xử lý ---")
 
     except Exception as e:
-        print(f"❌ Lỗi khi ghi file JSON '{OUTPUT_JSON}': {e}")
+        print(f"❌ Lỗi khi ghi file '{OUTPUT_JSON}': {e}")
         sys.exit(1)
 
 if __name__ == "__main__":
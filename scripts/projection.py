@@ -0,0 +1,71 @@
+"""
+Giảm số chiều vector embedding trước khi đưa vào index (tiết kiệm heap ES).
+- 'pca': PCA fit trên embedding của catalog (SVD trên dữ liệu đã trừ mean)
+- 'truncate': giữ `dim` chiều đầu (Matryoshka; chỉ hợp lý với model huấn luyện kiểu Matryoshka)
+Vector sau chiếu được chuẩn hóa L2 (index dùng cosine).
+Phép chiếu lưu ra file .npz và được import_to_elasticsearch.py ghi kèm index (có version) để
+backend dùng đúng phép chiếu đó cho vector truy vấn.
+"""
+import hashlib
+import os
+import numpy as np
+
+PROJECTION_METHODS = ('none', 'pca', 'truncate')
+
+class Projection:
+    def __init__(self, method, mean, components, model_key=''):
+        self.method = method
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32) # (dim x source_dim)
+        self.model_key = model_key
+
+    @property
+    def source_dim(self): return self.components.shape[1]
+
+    @property
+    def dim(self): return self.components.shape[0]
+
+    @property
+    def version(self):
+        """ Version = hash nội dung phép chiếu: fit lại ra cùng kết quả thì version không đổi """
+        digest = hashlib.sha1(self.method.encode('utf-8') + self.model_key.encode('utf-8'))
+        digest.update(self.mean.tobytes())
+        digest.update(self.components.tobytes())
+        return f"{self.method}-{self.dim}-{digest.hexdigest()[:12]}"
+
+    def apply(self, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        projected = (vectors - self.mean) @ self.components.T
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected / np.maximum(norms, 1e-12)
+
+    def metadata(self):
+        return {"version": self.version, "method": self.method, "dim": self.dim,
+                "source_dim": self.source_dim, "model_key": self.model_key}
+
+    def save(self, file_path):
+        os.makedirs(os.path.dirname(file_path) or '.', exist_ok=True)
+        np.savez(file_path, method=self.method, mean=self.mean, components=self.components, model_key=self.model_key)
+
+    @classmethod
+    def load(cls, file_path):
+        with np.load(file_path) as data:
+            return cls(str(data['method']), data['mean'], data['components'], str(data['model_key']))
+
+def fit_projection(vectors, method, dim, model_key='', max_samples=50000, seed=0):
+    """ Fit phép chiếu trên (tối đa max_samples) vector. dim >= số chiều gốc -> trả về None (không cần chiếu). """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    source_dim = vectors.shape[1]
+    if method == 'none' or dim >= source_dim: return None
+    if method == 'truncate':
+        return Projection(method, np.zeros(source_dim, dtype=np.float32), np.eye(dim, source_dim, dtype=np.float32), model_key)
+    if method != 'pca': raise ValueError(f"Phương pháp chiếu '{method}' không hỗ trợ ({', '.join(PROJECTION_METHODS)}).")
+    if len(vectors) < dim: raise ValueError(f"Cần ít nhất {dim} vector để fit PCA {dim} chiều (có {len(vectors)}).")
+    if len(vectors) > max_samples:
+        vectors = vectors[np.random.default_rng(seed).choice(len(vectors), max_samples, replace=False)]
+    mean = vectors.mean(axis=0)
+    _, _, vt = np.linalg.svd(vectors - mean, full_matrices=False)
+    components = vt[:dim]
+    # Cố định dấu từng thành phần để fit lại trên cùng dữ liệu luôn ra cùng version
+    signs = np.sign(components[np.arange(dim), np.abs(components).argmax(axis=1)])
+    return Projection(method, mean, components * signs[:, None], model_key)